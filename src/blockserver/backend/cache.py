@@ -1,12 +1,17 @@
 from __future__ import annotations
 import redis
-from typing import Dict, List
+from typing import Dict, List, Tuple, Union
+from uuid import uuid4
 
 from abc import abstractmethod, ABC
+from blockserver.backend import util
 from blockserver.backend.util import User
 from blockserver.backend.transfer import StorageObject, file_key
 
 AUTH_CACHE_EXPIRE = 60
+USAGE_CACHE_EXPIRE = 300
+OWNER_CACHE_EXPIRE = 24 * 60 * 60
+DIGEST_CACHE_EXPIRE = 24 * 60 * 60
 
 
 class AbstractCache(ABC):
@@ -25,6 +30,12 @@ class AbstractCache(ABC):
             raise ValueError('No size set in StorageObject')
         self._set(key, etag=storage_object.etag.encode(), size=storage_object.size)
 
+    def delete_storage(self, storage_object: StorageObject):
+        """
+        Forgets the etag and size of a deleted StorageObject
+        """
+        self._delete(self._storage_key(storage_object))
+
     def get_storage(self, storage_object: StorageObject) -> StorageObject:
         """
         Gets the etag and size of a StorageObject according to the cache
@@ -74,6 +85,144 @@ class AbstractCache(ABC):
     def get_user(self, user_id: int) -> User:
         return self._get_user('user-%d' % user_id)
 
+    def set_usage(self, user_id: int, size: int):
+        """
+        Saves the used storage of a user as read from the database
+        """
+        key = 'usage-%d' % user_id
+        self._set(key, size=size)
+        self._set_expire(key, USAGE_CACHE_EXPIRE)
+
+    def get_usage(self, user_id: int) -> int:
+        """
+        Gets the used storage of a user according to the cache
+
+        Raises a KeyError if the usage is not known
+        """
+        size, = self._get('usage-%d' % user_id, 'size')
+        if size is None:
+            raise KeyError('Element not found')
+        return int(size)
+
+    def incr_usage(self, user_id: int, change: int):
+        """
+        Applies a size change to the cached usage, if the usage is cached at all
+        """
+        self._incr('usage-%d' % user_id, 'size', change)
+
+    def reserve_usage(self, user_id: int, needed: int, amount: int, quota: int) -> Union[bool, None]:
+        """
+        Atomically reserves *amount* bytes for an upload if *needed* more bytes fit into *quota*
+
+        Reservations count as used until they are committed or released with commit_usage.
+        Returns None if the usage is not cached (seed it with set_usage), otherwise whether the reservation was made.
+        """
+        result = self._reserve('usage-%d' % user_id, needed, amount, quota)
+        return None if result is None else bool(result)
+
+    def commit_usage(self, user_id: int, reserved: int, change: int):
+        """
+        Replaces a reservation of *reserved* bytes by the actual size *change* (0 to just release it)
+        """
+        self._commit('usage-%d' % user_id, reserved, change)
+
+    def set_traffic(self, user_id: int, traffic: int):
+        key = self._traffic_key(user_id)
+        self._set(key, traffic=traffic)
+        self._set_expire(key, USAGE_CACHE_EXPIRE)
+
+    def get_traffic(self, user_id: int) -> int:
+        traffic, = self._get(self._traffic_key(user_id), 'traffic')
+        if traffic is None:
+            raise KeyError('Element not found')
+        return int(traffic)
+
+    def incr_traffic(self, user_id: int, amount: int):
+        self._incr(self._traffic_key(user_id), 'traffic', amount)
+
+    def set_prefix_owner(self, prefix: str, user_id: int):
+        key = 'owner-' + prefix
+        self._set(key, user_id=user_id)
+        self._set_expire(key, OWNER_CACHE_EXPIRE)
+
+    def get_prefix_owner(self, prefix: str) -> int:
+        user_id, = self._get('owner-' + prefix, 'user_id')
+        if user_id is None:
+            raise KeyError('Element not found')
+        return int(user_id)
+
+    def set_content_digest(self, storage_object: StorageObject, digest: str):
+        """
+        Saves the digest of the blob a deduplicated StorageObject refers to ('' if it isn't deduplicated)
+        """
+        key = 'digest-' + file_key(storage_object)
+        self._set(key, digest=digest.encode())
+        self._set_expire(key, DIGEST_CACHE_EXPIRE)
+
+    def get_content_digest(self, storage_object: StorageObject) -> str:
+        """
+        Gets the digest of the blob of a StorageObject according to the cache ('' if it isn't deduplicated)
+
+        Raises a KeyError if it is not known
+        """
+        digest, = self._get('digest-' + file_key(storage_object), 'digest')
+        if digest is None:
+            raise KeyError('Element not found')
+        return digest.decode()
+
+    def delete_content_digest(self, storage_object: StorageObject):
+        self._delete('digest-' + file_key(storage_object))
+
+    def set_tombstone(self, storage_object: StorageObject):
+        """
+        Marks a StorageObject as deleted while it is still in the storage backend (deferred deletes)
+
+        Tombstones don't expire, they are deleted once the object is removed or stored again.
+        """
+        self._set('tombstone-' + file_key(storage_object), deleted=b'1')
+
+    def is_tombstone(self, storage_object: StorageObject) -> bool:
+        deleted, = self._get('tombstone-' + file_key(storage_object), 'deleted')
+        return deleted is not None
+
+    def delete_tombstone(self, storage_object: StorageObject):
+        self._delete('tombstone-' + file_key(storage_object))
+
+    def record_access(self, storage_object: StorageObject, now: float) -> int:
+        """
+        Records an access to a StorageObject at *now* (a timestamp)
+
+        Returns the number of accesses since the object was last forgotten (see forget_access).
+        """
+        return int(self._record_access(file_key(storage_object), now))
+
+    def get_last_access(self, storage_object: StorageObject) -> Union[float, None]:
+        return self._last_access(file_key(storage_object))
+
+    def get_least_recently_accessed(self, count: int) -> List[Tuple[str, float]]:
+        """
+        Gets the file keys and last access times of the *count* least recently accessed objects
+        """
+        return [(key.decode(), access) for key, access in self._least_recent(count)]
+
+    def forget_access(self, storage_object: StorageObject):
+        self._forget_access(file_key(storage_object))
+
+    def lock(self, name: str, time_to_live: int) -> Union[str, None]:
+        """
+        Takes the lock *name* for at most *time_to_live* seconds, returns the token to unlock it with if it was free,
+        otherwise None
+        """
+        token = uuid4().hex
+        return token if self._lock('lock-' + name, time_to_live, token) else None
+
+    def unlock(self, name: str, token: str) -> bool:
+        """Release the lock *name* if it is still held with *token*, return whether it was (it may have expired)."""
+        return bool(self._unlock('lock-' + name, token))
+
+    def _traffic_key(self, user_id):
+        return 'traffic-%d-%s' % (user_id, util.this_month().isoformat())
+
     def _storage_key(self, storage_object):
         return self.STORAGE_PREFIX + file_key(storage_object)
 
@@ -92,14 +241,99 @@ class AbstractCache(ABC):
     def _set_expire(self, key, time_to_live):
         pass
 
+    @abstractmethod
+    def _delete(self, key: str):
+        pass
+
+    @abstractmethod
+    def _incr(self, key: str, field: str, amount: int):
+        """Increment *field* of *key* by *amount*, but only if *key* exists."""
+
+    @abstractmethod
+    def _reserve(self, key: str, needed: int, amount: int, limit: int) -> Union[int, None]:
+        """
+        Atomically add *amount* to the reserved field of *key* if size + reserved + *needed* <= *limit*.
+
+        Return None if *key* doesn't exist, 1 if reserved and 0 otherwise.
+        """
+
+    @abstractmethod
+    def _commit(self, key: str, reserved: int, change: int):
+        """Atomically move *reserved* from the reserved field to the size field of *key* as *change*."""
+
+    @abstractmethod
+    def _record_access(self, key: str, now: float) -> int:
+        """Set the last access of *key* to *now*, increment and return its access count."""
+
+    @abstractmethod
+    def _last_access(self, key: str) -> Union[float, None]:
+        pass
+
+    @abstractmethod
+    def _least_recent(self, count: int) -> List[Tuple[bytes, float]]:
+        pass
+
+    @abstractmethod
+    def _forget_access(self, key: str):
+        pass
+
+    @abstractmethod
+    def _lock(self, key: str, time_to_live: int, token: str) -> bool:
+        """Set *key* to *token* if it doesn't exist, expiring after *time_to_live* seconds. Return whether it was set."""
+
+    @abstractmethod
+    def _unlock(self, key: str, token: str) -> bool:
+        """Atomically delete *key* if it is set to *token*, return whether it was."""
+
 
 class RedisCache(AbstractCache):
     """
     Cache ETags from StorageObjects in redis
     """
 
+    INCR_EXISTING = """
+    if redis.call('exists', KEYS[1]) == 1 then
+        return redis.call('hincrby', KEYS[1], ARGV[1], ARGV[2])
+    end
+    """
+
+    RESERVE = """
+    if redis.call('exists', KEYS[1]) == 0 then
+        return nil
+    end
+    local size = tonumber(redis.call('hget', KEYS[1], 'size'))
+    local reserved = tonumber(redis.call('hget', KEYS[1], 'reserved') or '0')
+    if size + reserved + tonumber(ARGV[1]) > tonumber(ARGV[3]) then
+        return 0
+    end
+    redis.call('hincrby', KEYS[1], 'reserved', ARGV[2])
+    return 1
+    """
+
+    COMMIT = """
+    if redis.call('exists', KEYS[1]) == 1 then
+        local reserved = tonumber(redis.call('hget', KEYS[1], 'reserved') or '0') - tonumber(ARGV[1])
+        redis.call('hset', KEYS[1], 'reserved', math.max(reserved, 0))
+        redis.call('hincrby', KEYS[1], 'size', ARGV[2])
+    end
+    """
+
+    UNLOCK = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    ACCESS_TIMES = 'access-times'
+    ACCESS_COUNTS = 'access-counts'
+
     def __init__(self, **redis_kwargs):
         self._cache = redis.StrictRedis(**redis_kwargs)
+        self._incr_existing = self._cache.register_script(self.INCR_EXISTING)
+        self._reserve_script = self._cache.register_script(self.RESERVE)
+        self._commit_script = self._cache.register_script(self.COMMIT)
+        self._unlock_script = self._cache.register_script(self.UNLOCK)
 
     def _set_expire(self, key, time_to_live):
         self._cache.expire(key, time_to_live)
@@ -110,5 +344,41 @@ class RedisCache(AbstractCache):
     def _set(self, key, **values):
         return self._cache.hmset(key, values)
 
+    def _delete(self, key):
+        self._cache.delete(key)
+
     def _get(self, key, *keys):
         return self._cache.hmget(key, keys)
+
+    def _incr(self, key, field, amount):
+        self._incr_existing(keys=[key], args=[field, amount])
+
+    def _reserve(self, key, needed, amount, limit):
+        return self._reserve_script(keys=[key], args=[needed, amount, limit])
+
+    def _commit(self, key, reserved, change):
+        self._commit_script(keys=[key], args=[reserved, change])
+
+    def _record_access(self, key, now):
+        pipeline = self._cache.pipeline()
+        pipeline.zadd(self.ACCESS_TIMES, {key: now})
+        pipeline.hincrby(self.ACCESS_COUNTS, key, 1)
+        return pipeline.execute()[1]
+
+    def _last_access(self, key):
+        return self._cache.zscore(self.ACCESS_TIMES, key)
+
+    def _least_recent(self, count):
+        return self._cache.zrange(self.ACCESS_TIMES, 0, count - 1, withscores=True)
+
+    def _forget_access(self, key):
+        pipeline = self._cache.pipeline()
+        pipeline.zrem(self.ACCESS_TIMES, key)
+        pipeline.hdel(self.ACCESS_COUNTS, key)
+        pipeline.execute()
+
+    def _lock(self, key, time_to_live, token):
+        return self._cache.set(key, token, nx=True, ex=time_to_live)
+
+    def _unlock(self, key, token):
+        return self._unlock_script(keys=[key], args=[token])
@@ -1,12 +1,20 @@
 from __future__ import annotations
-from typing import List
+import itertools
+import logging
+import time
+from typing import Dict, List, Sequence, Set, Tuple, Union
 import psycopg2
 import psycopg2.extensions
+from psycopg2.pool import SimpleConnectionPool, PoolError
 from abc import abstractmethod, ABC
 from uuid import uuid4
 from contextlib import contextmanager
 
 from . import util
+from .transfer import CAS_PREFIX
+from .. import monitoring as mon
+
+logger = logging.getLogger(__name__)
 
 
 class AbstractUserDatabase(ABC):
@@ -41,14 +49,53 @@ class AbstractUserDatabase(ABC):
 
 
 class PostgresUserDatabase(AbstractUserDatabase):
+    """
+    User database on PostgreSQL.
+
+    Writes always go to *connection* (the primary). If a *replica_connection* is given, read-only queries are sent
+    there instead, until this instance writes something: from then on it reads from the primary as well, so a request
+    always sees its own writes.
+    """
 
-    def __init__(self, connection: psycopg2.extensions.connection):
+    def __init__(self, connection: psycopg2.extensions.connection,
+                 replica_connection: psycopg2.extensions.connection = None):
         self.connection = connection
+        self.replica_connection = replica_connection
+        self._wrote = False
+        self._in_transaction = False
 
     @contextmanager
     def _cur(self):
-        with self.connection:
+        self._wrote = True
+        with self._primary_cur() as cur:
+            yield cur
+
+    @contextmanager
+    def _primary_cur(self):
+        if self._in_transaction:
             yield self.connection.cursor()  # type: psycopg2.extensions.cursor
+            return
+        with self.connection:
+            self._in_transaction = True
+            try:
+                yield self.connection.cursor()  # type: psycopg2.extensions.cursor
+            finally:
+                self._in_transaction = False
+
+    @contextmanager
+    def transaction(self):
+        """Run all queries issued inside the block in one transaction on the primary."""
+        with self._cur():
+            yield
+
+    @contextmanager
+    def _read_cur(self):
+        if self.replica_connection is None or self._wrote:
+            with self._cur() as cur:
+                yield cur
+        else:
+            with self.replica_connection:
+                yield self.replica_connection.cursor()  # type: psycopg2.extensions.cursor
 
     def create_prefix(self, user_id: int) -> str:
         self.assert_user_exists(user_id)
@@ -69,7 +116,7 @@ class PostgresUserDatabase(AbstractUserDatabase):
                 pass
 
     def get_prefix_owner(self, prefix: str) -> int:
-        with self._cur() as cur:
+        with self._read_cur() as cur:
             cur.execute(
                 'SELECT user_id FROM users NATURAL JOIN prefixes WHERE prefixes.name = %s',
                 (prefix,))
@@ -77,14 +124,20 @@ class PostgresUserDatabase(AbstractUserDatabase):
             return result[0] if result else None
 
     def has_prefix(self, user_id: int, prefix: str) -> bool:
-        with self._cur() as cur:
-            cur.execute(
-                'SELECT 1 FROM prefixes WHERE user_id=%s AND name=%s',
-                (user_id, prefix))
+        query = 'SELECT 1 FROM prefixes WHERE user_id=%s AND name=%s'
+        with self._read_cur() as cur:
+            cur.execute(query, (user_id, prefix))
+            if cur.rowcount == 1:
+                return True
+        if self.replica_connection is None or self._wrote:
+            return False
+        # a prefix created moments ago may not have reached the replica yet
+        with self._primary_cur() as cur:
+            cur.execute(query, (user_id, prefix))
             return cur.rowcount == 1
 
     def get_prefixes(self, user_id: int) -> List[str]:
-        with self._cur() as cur:
+        with self._read_cur() as cur:
             cur.execute(
                 'SELECT name FROM prefixes WHERE user_id=%s',
                 (user_id,))
@@ -99,7 +152,7 @@ class PostgresUserDatabase(AbstractUserDatabase):
                 (change, prefix))
 
     def get_size(self, user_id: int) -> int:
-        with self._cur() as cur:
+        with self._read_cur() as cur:
             cur.execute(
                 'SELECT size FROM users WHERE user_id = %s',
                 (user_id,))
@@ -121,7 +174,7 @@ class PostgresUserDatabase(AbstractUserDatabase):
                 (amount, util.this_month(), prefix))
 
     def get_traffic(self, user_id: int) -> int:
-        with self._cur() as cur:
+        with self._read_cur() as cur:
             cur.execute('SELECT traffic FROM traffic WHERE user_id = %s AND traffic_month = %s',
                         (user_id, util.this_month()))
             traffic = cur.fetchone()
@@ -130,7 +183,7 @@ class PostgresUserDatabase(AbstractUserDatabase):
             return traffic[0]
 
     def get_traffic_by_prefix(self, prefix: str) -> int:
-        with self._cur() as cur:
+        with self._read_cur() as cur:
             cur.execute('SELECT traffic FROM traffic JOIN prefixes USING (user_id)'
                         'WHERE name = %s AND traffic_month = %s',
                         (prefix, util.this_month()))
@@ -141,8 +194,297 @@ class PostgresUserDatabase(AbstractUserDatabase):
                 traffic, = result
             return traffic
 
+    def store_object(self, prefix: str, path: str, size: int, etag: str, size_change: int, digest: str = None,
+                     checksum: str = None):
+        """
+        Catalog a stored object and account its *size_change* in one transaction.
+
+        *digest* is given for deduplicated objects, whose content is the blob with that digest. *checksum* is the
+        SHA-256 of the content, if known.
+        """
+        with self.transaction():
+            if size_change != 0:
+                self.update_size(prefix, size_change)
+            with self._cur() as cur:
+                cur.execute(
+                    'INSERT INTO objects (prefix, path, size, etag, digest, checksum) '
+                    'VALUES (%s, %s, %s, %s, %s, %s) '
+                    'ON CONFLICT (prefix, path) DO UPDATE '
+                    'SET size = EXCLUDED.size, etag = EXCLUDED.etag, digest = EXCLUDED.digest, '
+                    'checksum = EXCLUDED.checksum, mtime = now()',
+                    (prefix, path, size, etag, digest, checksum))
+
+    def store_objects(self, prefix: str, objects: Sequence[Tuple[str, int, str, str]], size_change: int):
+        """
+        Catalog many stored objects, given as (path, size, etag, checksum), and account their total *size_change* in
+        one transaction.
+        """
+        paths, sizes, etags, checksums = zip(*objects) if objects else ((), (), (), ())
+        with self.transaction():
+            if size_change != 0:
+                self.update_size(prefix, size_change)
+            with self._cur() as cur:
+                cur.execute(
+                    'INSERT INTO objects (prefix, path, size, etag, checksum) '
+                    'SELECT %s, * FROM unnest(%s::text[], %s::bigint[], %s::text[], %s::text[]) '
+                    'ON CONFLICT (prefix, path) DO UPDATE '
+                    'SET size = EXCLUDED.size, etag = EXCLUDED.etag, digest = NULL, '
+                    'checksum = EXCLUDED.checksum, mtime = now()',
+                    (prefix, list(paths), list(sizes), list(etags), list(checksums)))
+
+    def delete_object(self, prefix: str, path: str, size_change: int):
+        """Remove an object from the catalog and account its *size_change* in one transaction."""
+        with self.transaction():
+            if size_change != 0:
+                self.update_size(prefix, size_change)
+            with self._cur() as cur:
+                cur.execute('DELETE FROM objects WHERE prefix = %s AND path = %s', (prefix, path))
+
+    def get_object(self, prefix: str, path: str) -> util.ObjectInfo:
+        # Always asks the primary: the result decides about overwrites (If-Match) and accounting.
+        with self._cur() as cur:
+            cur.execute('SELECT path, size, etag, mtime, digest, checksum FROM objects '
+                        'WHERE prefix = %s AND path = %s', (prefix, path))
+            result = cur.fetchone()
+            return util.ObjectInfo(*result) if result else None
+
+    def get_objects(self, prefix: str, paths: Sequence[str]) -> Dict[str, util.ObjectInfo]:
+        """Return the catalog entries of those of *paths* that are catalogued, by path."""
+        with self._cur() as cur:
+            cur.execute('SELECT path, size, etag, mtime, digest, checksum FROM objects '
+                        'WHERE prefix = %s AND path = ANY(%s)', (prefix, list(paths)))
+            return {row[0]: util.ObjectInfo(*row) for row in cur.fetchall()}
+
+    def delete_objects(self, prefix: str, paths: Sequence[str], size_change: int):
+        """Remove objects from the catalog and account their total *size_change* in one transaction."""
+        with self.transaction():
+            if size_change != 0:
+                self.update_size(prefix, size_change)
+            with self._cur() as cur:
+                cur.execute('DELETE FROM objects WHERE prefix = %s AND path = ANY(%s)', (prefix, list(paths)))
+
+    def list_objects(self, prefix: str, after: str = None, limit: int = 1000) -> List[util.ObjectInfo]:
+        """Return up to *limit* catalogued objects of *prefix* ordered by path, starting after the path *after*."""
+        with self._read_cur() as cur:
+            cur.execute('SELECT path, size, etag, mtime FROM objects '
+                        'WHERE prefix = %s AND path > %s ORDER BY path LIMIT %s',
+                        (prefix, after or '', limit))
+            return [util.ObjectInfo(*row) for row in cur.fetchall()]
+
+    def link_blob(self, digest: str) -> bool:
+        """
+        Add a reference to the blob *digest* if it exists, return whether it did. Otherwise its content has to be
+        stored first, and then referenced with add_blob.
+        """
+        with self._cur() as cur:
+            cur.execute('UPDATE blobs SET refcount = refcount + 1 WHERE digest = %s', (digest,))
+            return cur.rowcount == 1
+
+    def add_blob(self, digest: str, size: int) -> Union[bool, None]:
+        """
+        Add a reference to the blob *digest* whose content was just stored, dequeuing a queued removal of it.
+
+        Return None if its content is being removed right now (see unlink_blob), it has to be stored again once that
+        is done.
+        """
+        with self.transaction():
+            if self.cancel_delete(CAS_PREFIX, digest) is None:
+                return None
+            with self._cur() as cur:
+                cur.execute('INSERT INTO blobs (digest, size, refcount) VALUES (%s, %s, 1) '
+                            'ON CONFLICT (digest) DO UPDATE SET refcount = blobs.refcount + 1',
+                            (digest, size))
+            return True
+
+    def unlink_blob(self, digest: str) -> bool:
+        """
+        Remove a reference to the blob *digest*, return True if it was the last one.
+
+        The last reference removes the blob and queues the removal of its content (see DeleteQueue), so no request
+        has to wait for the storage backend while the blob is locked.
+        """
+        with self.transaction():
+            with self._cur() as cur:
+                cur.execute('UPDATE blobs SET refcount = refcount - 1 WHERE digest = %s RETURNING refcount',
+                            (digest,))
+                result = cur.fetchone()
+                if result is None or result[0] > 0:
+                    return False
+                cur.execute('DELETE FROM blobs WHERE digest = %s', (digest,))
+            self.defer_delete(CAS_PREFIX, digest)
+            return True
+
+    def get_deduplicated_size(self, prefix: str) -> int:
+        """Return the total size of the deduplicated objects of *prefix*."""
+        with self._read_cur() as cur:
+            cur.execute('SELECT coalesce(sum(size), 0) FROM objects WHERE prefix = %s AND digest IS NOT NULL',
+                        (prefix,))
+            return cur.fetchone()[0]
+
+    def defer_delete(self, prefix: str, path: str):
+        """Queue the removal of a deleted object from the storage backend."""
+        self.defer_deletes(prefix, [path])
+
+    def defer_deletes(self, prefix: str, paths: Sequence[str]):
+        with self._cur() as cur:
+            cur.execute('INSERT INTO pending_deletions (prefix, path) SELECT %s, unnest(%s::text[]) '
+                        'ON CONFLICT (prefix, path) DO NOTHING',
+                        (prefix, list(paths)))
+
+    def is_delete_pending(self, prefix: str, path: str) -> bool:
+        # Always asks the primary, like get_object.
+        with self._cur() as cur:
+            cur.execute('SELECT 1 FROM pending_deletions WHERE prefix = %s AND path = %s', (prefix, path))
+            return cur.rowcount == 1
+
+    def pending_deletes(self, prefix: str, paths: Sequence[str]) -> Set[str]:
+        """Return those of *paths* whose removal is queued."""
+        with self._cur() as cur:
+            cur.execute('SELECT path FROM pending_deletions WHERE prefix = %s AND path = ANY(%s)',
+                        (prefix, list(paths)))
+            return {row[0] for row in cur.fetchall()}
+
+    def cancel_delete(self, prefix: str, path: str) -> Union[bool, None]:
+        """
+        Dequeue the removal of an object that is stored again, return whether it was queued.
+
+        Return None if it is being removed right now (see take_pending_deletes), without waiting for that.
+        """
+        cancelled, removing = self.cancel_deletes(prefix, [path])
+        return None if removing else bool(cancelled)
+
+    def cancel_deletes(self, prefix: str, paths: Sequence[str]) -> Tuple[Set[str], Set[str]]:
+        """
+        Dequeue the removals of objects that are stored again, return those of *paths* that were queued and those
+        that are being removed right now (see cancel_delete).
+        """
+        with self._cur() as cur:
+            cur.execute('DELETE FROM pending_deletions WHERE ctid IN ('
+                        'SELECT ctid FROM pending_deletions WHERE prefix = %s AND path = ANY(%s) '
+                        'FOR UPDATE SKIP LOCKED) '
+                        'RETURNING path',
+                        (prefix, list(paths)))
+            cancelled = {row[0] for row in cur.fetchall()}
+        remaining = [path for path in paths if path not in cancelled]
+        return cancelled, self.pending_deletes(prefix, remaining) if remaining else set()
+
+    def take_pending_deletes(self, limit: int) -> List[Tuple[str, str]]:
+        """
+        Return (prefix, path) of up to *limit* queued removals, oldest first.
+
+        Call in a transaction() that also removes the objects and finishes with remove_pending_deletes: the rows stay
+        locked until then, so concurrent removers skip them and cancel_delete doesn't dequeue them.
+        """
+        with self._cur() as cur:
+            cur.execute('SELECT prefix, path FROM pending_deletions ORDER BY queued LIMIT %s FOR UPDATE SKIP LOCKED',
+                        (limit,))
+            return [tuple(row) for row in cur.fetchall()]
+
+    def remove_pending_deletes(self, pending: Sequence[Tuple[str, str]]):
+        with self._cur() as cur:
+            cur.execute('DELETE FROM pending_deletions d USING unnest(%s::text[], %s::text[]) AS r(prefix, path) '
+                        'WHERE d.prefix = r.prefix AND d.path = r.path',
+                        ([prefix for prefix, _ in pending], [path for _, path in pending]))
+
+    def get_user_ids(self, after: int = None) -> List[int]:
+        """Return the ids of all users (with an id greater than *after*) in ascending order."""
+        with self._read_cur() as cur:
+            if after is None:
+                cur.execute('SELECT user_id FROM users ORDER BY user_id')
+            else:
+                cur.execute('SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id', (after,))
+            return [row[0] for row in cur.fetchall()]
+
+    def get_size_snapshot(self, user_id: int) -> Tuple[int, str]:
+        """Return the used storage of *user_id* and the version of the row it was read from (see correct_size)."""
+        with self._cur() as cur:
+            cur.execute('SELECT size, xmin::text FROM users WHERE user_id = %s', (user_id,))
+            return cur.fetchone()
+
+    def correct_size(self, user_id: int, version: str, actual: int) -> bool:
+        """
+        Correct the used storage of *user_id* to *actual*, unless it changed since the snapshot with *version* was
+        taken. Returns whether it was corrected.
+
+        Storing and deleting while *actual* was counted may or may not be part of it, such users have to be
+        recounted.
+        """
+        with self._cur() as cur:
+            cur.execute('UPDATE users SET size = %s WHERE user_id = %s AND xmin::text = %s',
+                        (actual, user_id, version))
+            return cur.rowcount == 1
+
     def _flush_all(self):
         with self._cur() as cur:
             cur.execute('DELETE FROM users')
             cur.execute('DELETE FROM prefixes')
             cur.execute('DELETE FROM traffic')
+            cur.execute('DELETE FROM objects')
+            cur.execute('DELETE FROM blobs')
+            cur.execute('DELETE FROM pending_deletions')
+
+
+class ReplicaPool:
+    """
+    Connection pools for read replicas.
+
+    getconn() hands out connections round-robin, but only to replicas whose replay lag is below *max_lag* seconds.
+    The lag is sampled at most every *check_interval* seconds per replica. If no replica is usable None is returned,
+    and the caller reads from the primary instead.
+    """
+
+    LAG_QUERY = ('SELECT CASE WHEN NOT pg_is_in_recovery() '
+                 'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                 'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END')
+
+    def __init__(self, dsns: Sequence[str], max_lag: float, check_interval: float = 5, minconn=1, maxconn=20):
+        self.pools = [SimpleConnectionPool(minconn, maxconn, dsn=dsn) for dsn in dsns]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lag = [None] * len(self.pools)
+        self._checked = [float('-inf')] * len(self.pools)
+        self._round_robin = itertools.count()
+        self._owner = {}
+
+    def getconn(self):
+        for _ in range(len(self.pools)):
+            index = next(self._round_robin) % len(self.pools)
+            if not self._is_fresh(index):
+                continue
+            try:
+                connection = self.pools[index].getconn()
+            except PoolError:
+                continue
+            self._owner[id(connection)] = index
+            return connection
+        return None
+
+    def putconn(self, connection):
+        index = self._owner.pop(id(connection))
+        self.pools[index].putconn(connection)
+
+    def _is_fresh(self, index):
+        now = time.monotonic()
+        if now - self._checked[index] > self.check_interval:
+            self._checked[index] = now
+            self._lag[index] = self._measure_lag(index)
+        return self._lag[index] is not None and self._lag[index] <= self.max_lag
+
+    def _measure_lag(self, index):
+        pool = self.pools[index]
+        try:
+            connection = pool.getconn()
+        except PoolError:
+            return self._lag[index]
+        try:
+            with connection:
+                cur = connection.cursor()
+                cur.execute(self.LAG_QUERY)
+                lag = float(cur.fetchone()[0])
+        except psycopg2.Error as error:
+            logger.warning('Read replica %d is unavailable, reading from the primary: %s', index, error)
+            pool.putconn(connection, close=True)
+            return None
+        pool.putconn(connection)
+        mon.DB_REPLICA_LAG.labels(str(index)).set(lag)
+        return lag
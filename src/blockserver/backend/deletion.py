@@ -0,0 +1,96 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+from typing import Callable
+
+import psycopg2
+from tornado.options import define, options
+
+from blockserver import monitoring as mon
+from blockserver.backend.database import PostgresUserDatabase
+from blockserver.backend.transfer import AbstractTransfer, StorageObject
+
+define('deferred_deletes', help='Respond to deletes once the object is removed from the catalog, and remove it from '
+                                'the storage backend in the background', default=False)
+define('deferred_delete_interval', help='Seconds between removals of deleted objects from the storage backend (0: '
+                                        'only by the purge maintenance job)', default=10)
+define('deferred_delete_batch', help='Maximum number of deleted objects removed from the storage backend at once '
+                                     '(uploads of them wait until the batch is removed)', default=100)
+
+logger = logging.getLogger(__name__)
+
+
+class DeleteQueue:
+    """
+    Removes objects deleted with --deferred-deletes, and the content of --dedup-blocks blobs that lost their last
+    reference (see PostgresUserDatabase.unlink_blob), from the storage backend.
+
+    Such a delete removes the object from the catalog (accounting its size right away), queues it in the
+    pending_deletions table and tombstones it in the cache, so it isn't served anymore. The queue is worked off in
+    batches (see AbstractTransfer.delete_many); storing an object again dequeues it (see
+    PostgresUserDatabase.cancel_delete). The rows of a batch stay locked while it is removed, stores of them wait for
+    that (see FileHandler.REMOVAL_TIMEOUT), so batches are kept small.
+    """
+
+    def __init__(self, db: PostgresUserDatabase, transfer: AbstractTransfer, cache,
+                 connect: Callable[[], PostgresUserDatabase] = None):
+        """*connect* opens a new database connection, the periodic purges reconnect with it once the *db* is lost."""
+        self.db = db
+        self.transfer = transfer
+        self.cache = cache
+        self.connect = connect
+
+    def start(self):
+        thread = threading.Thread(target=self._purge_periodically, name='deferred-deletes', daemon=True)
+        thread.start()
+
+    def purge_batch(self) -> int:
+        """Remove up to --deferred-delete-batch queued objects, return how many."""
+        with self.db.transaction():
+            pending = self.db.take_pending_deletes(options.deferred_delete_batch)
+            if not pending:
+                return 0
+            storage_objects = [StorageObject(prefix, path) for prefix, path in pending]
+            self.transfer.delete_many(storage_objects)
+            self.db.remove_pending_deletes(pending)
+        for storage_object in storage_objects:
+            self.cache.delete_tombstone(storage_object)
+        mon.DELETES_PURGED.inc(len(pending))
+        return len(pending)
+
+    def purge(self) -> int:
+        """Remove all queued objects, return how many."""
+        purged = 0
+        while True:
+            removed = self.purge_batch()
+            if not removed:
+                return purged
+            purged += removed
+
+    def _purge_periodically(self):
+        while True:
+            time.sleep(options.deferred_delete_interval)
+            self._purge_logged()
+
+    def _purge_logged(self):
+        try:
+            purged = self.purge()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            logger.exception('Removing deleted objects failed, reconnecting to the database')
+            self._reconnect()
+        except Exception:
+            logger.exception('Removing deleted objects failed')
+        else:
+            if purged:
+                logger.info('Removed %d deleted objects', purged)
+
+    def _reconnect(self):
+        if self.connect is None:
+            return
+        self.db.connection.close()
+        try:
+            self.db = self.connect()
+        except psycopg2.Error:
+            # tried again after the next purge fails
+            logger.exception('Reconnecting to the database failed')
@@ -0,0 +1,118 @@
+from __future__ import annotations
+import logging
+import math
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, TimeoutError, wait
+from time import perf_counter
+
+from blockserver import monitoring as mon
+from blockserver.backend.resilience import classify
+
+logger = logging.getLogger(__name__)
+
+
+class Hedger:
+    """
+    Hedges slow requests: if a request hasn't returned after the *percentile* of the recent latencies of its
+    *operation*, the same request is sent again and whichever response arrives first is used.
+
+    Requests run on *executor* (so the caller can stop waiting for them). Every request earns *budget* hedges and each
+    hedge spends one, which caps the extra load at that fraction of the requests, even when the backend is slow as a
+    whole. The losing response is passed to *discard* once it arrives, e.g. to close its body.
+
+    With a *limiter* (a ConcurrencyLimiter) the second request takes a slot of its own, the request isn't hedged if none
+    is free. The caller holds the slot of the first request; the extra slot is given back once both requests finished,
+    so the loser still counts while it is in flight.
+    """
+
+    # Number of recent latencies the delay is computed from
+    WINDOW = 1000
+    # No hedging before this many latencies were observed
+    MIN_SAMPLES = 50
+    # Maximum number of hedges saved up while requests were fast
+    BURST = 10
+
+    def __init__(self, executor, operation, percentile, budget, limiter=None):
+        self.executor = executor
+        self.operation = operation
+        self.percentile = percentile
+        self.budget = budget
+        self.limiter = limiter
+        self._latencies = deque(maxlen=self.WINDOW)
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Return the seconds after which a request is hedged, None while there are too few observations."""
+        with self._lock:
+            if len(self._latencies) < self.MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        index = math.ceil(len(latencies) * self.percentile / 100) - 1
+        return latencies[min(max(index, 0), len(latencies) - 1)]
+
+    def _observe(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _earn(self):
+        with self._lock:
+            self._tokens = min(self.BURST, self._tokens + self.budget)
+
+    def _spend(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _timed(self, function):
+        start = perf_counter()
+        try:
+            return function()
+        finally:
+            self._observe(perf_counter() - start)
+
+    def call(self, function, discard=None):
+        """Return the result of *function*(), calling it a second time if the first call is slow."""
+        mon.S3_HEDGEABLE_REQUESTS.labels(self.operation).inc()
+        self._earn()
+        delay = self.delay()
+        if delay is None:
+            return self._timed(function)
+        first = self.executor.submit(self._timed, function)
+        try:
+            return first.result(timeout=delay)
+        except TimeoutError:
+            pass
+        if self.limiter is not None and not self.limiter.try_acquire():
+            return first.result()
+        if not self._spend():
+            if self.limiter is not None:
+                self.limiter.release()
+            return first.result()
+        mon.S3_HEDGES.labels(self.operation).inc()
+        second = self.executor.submit(function)
+        done, _ = wait((first, second), return_when=FIRST_COMPLETED)
+        winner = first if first in done else second
+        loser = second if winner is first else first
+        if winner is second:
+            mon.S3_HEDGE_WINS.labels(self.operation).inc()
+        if self.limiter is not None:
+            loser.add_done_callback(self._release)
+        if discard is not None:
+            loser.add_done_callback(lambda future: self._discard(future, discard))
+        return winner.result()
+
+    def _release(self, future):
+        error = future.exception()
+        self.limiter.release(error is not None and classify(error)[1])
+
+    def _discard(self, future, discard):
+        if future.exception() is not None:
+            return
+        try:
+            discard(future.result())
+        except Exception:
+            logger.exception('Discarding the losing response of a hedged %s request failed', self.operation)
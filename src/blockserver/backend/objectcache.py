@@ -0,0 +1,167 @@
+from __future__ import annotations
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from blockserver import monitoring as mon
+
+logger = logging.getLogger(__name__)
+
+
+class DiskObjectCache:
+    """
+    Size-bounded on-disk cache of object contents, keyed by file key and etag.
+
+    Entries are filled atomically (written to a temporary file that is renamed when complete). Hits refresh the mtime
+    of an entry, and once the cache grows beyond *max_size* bytes the least recently used entries (and abandoned
+    temporary files) are evicted.
+
+    Several processes may share one directory: each tracks the size it added approximately, but eviction always
+    rescans the directory.
+    """
+
+    # Fraction of max_size the cache is shrunk to by an eviction
+    LOW_WATERMARK = 0.9
+    # Objects larger than this fraction of max_size are not cached
+    MAX_OBJECT_FRACTION = 0.1
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self._remove_old_fills()
+        self._lock = threading.Lock()
+        self._size = sum(size for _, size, _ in self._entries())
+        mon.DISK_CACHE_SIZE.set(self._size)
+
+    def _remove_old_fills(self):
+        """Remove temporary files that older versions left in the cache directory itself, eviction doesn't see them."""
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.fill-') and entry.is_file(follow_symlinks=False):
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def _path(self, key, etag):
+        digest = hashlib.sha256('{}\0{}'.format(key, etag).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def open(self, key, etag):
+        """Return the cached contents of *key* at *etag* as a file object, or None if they aren't cached."""
+        path = self._path(key, etag)
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            mon.DISK_CACHE_MISSES.inc()
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # evicted meanwhile, the open file is still fine
+        mon.DISK_CACHE_HITS.inc()
+        return file
+
+    def fill(self, key, etag, size, source):
+        """
+        Return a file object reading *source*, which also stores everything read in the cache.
+
+        The entry is added when the returned file is closed after all *size* bytes have been read.
+        """
+        if size > self.max_size * self.MAX_OBJECT_FRACTION:
+            return source
+        try:
+            return FillingReader(self, self._path(key, etag), size, source)
+        except OSError as error:
+            logger.warning('Cannot fill disk cache: %s', error)
+            return source
+
+    def _add(self, temporary, path, size):
+        os.rename(temporary, path)
+        with self._lock:
+            self._size += size
+            evict = self._size > self.max_size
+        if evict:
+            self.evict()
+        mon.DISK_CACHE_SIZE.set(self._size)
+
+    def _entries(self):
+        with os.scandir(self.directory) as directories:
+            for directory in directories:
+                if not directory.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(directory.path) as entries:
+                    for entry in entries:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except FileNotFoundError:
+                            continue
+                        yield st.st_mtime_ns, st.st_size, entry.path
+
+    def evict(self):
+        """Remove least recently used entries until the cache is below its low watermark."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_size * self.LOW_WATERMARK
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self._size = total
+
+
+class FillingReader:
+    """File-like object passing reads of *source* through, while writing them to a cache entry."""
+
+    def __init__(self, cache: DiskObjectCache, path, size, source):
+        self._cache = cache
+        self._path = path
+        self._size = size
+        self._source = source
+        # next to the entry, so eviction also removes fills that were never closed
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, self._temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.fill-')
+        self._file = open(fd, 'wb')
+        self._written = 0
+
+    def read(self, size=-1):
+        data = self._source.read(size if size >= 0 else None)
+        if self._file is not None and data:
+            try:
+                self._file.write(data)
+                self._written += len(data)
+            except OSError as error:
+                logger.warning('Cannot fill disk cache: %s', error)
+                self._discard()
+        return data
+
+    def _discard(self):
+        self._file.close()
+        self._file = None
+        os.unlink(self._temporary)
+
+    def close(self):
+        self._source.close()
+        if self._file is None:
+            return
+        if self._written != self._size:
+            self._discard()
+            return
+        self._file.close()
+        self._file = None
+        try:
+            self._cache._add(self._temporary, self._path, self._size)
+        except OSError as error:
+            logger.warning('Cannot fill disk cache: %s', error)
+            try:
+                os.unlink(self._temporary)
+            except FileNotFoundError:
+                pass
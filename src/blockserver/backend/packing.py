@@ -0,0 +1,293 @@
+from __future__ import annotations
+import fcntl
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+from typing import Iterator, Tuple, Union
+
+from tornado.options import define, options
+
+from blockserver.backend.transfer import AbstractTransfer, LocalTransfer, StorageObject, file_key
+
+define('local_pack_threshold', help='Pack locally stored files up to this size (in bytes) into segment files '
+                                    '(0: disabled)', default=0)
+define('local_pack_segment_size', help='Size in bytes after which a new segment file is started',
+       default=64 * 1024**2)
+define('compact_garbage', help='Fraction of deleted data in a segment file that makes the compact job rewrite it',
+       default=0.5)
+
+logger = logging.getLogger(__name__)
+
+# magic, key length, data length, etag (time in ns)
+RECORD_HEADER = struct.Struct('>4sHIQ')
+RECORD_MAGIC = b'QBPK'
+
+
+class SegmentReader:
+    """Read-only file-like object for a record of a segment file."""
+
+    def __init__(self, fd, offset, length):
+        self._fd = fd
+        self._position = offset
+        self._end = offset + length
+
+    def read(self, size=-1):
+        remaining = self._end - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = os.pread(self._fd, size, self._position)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class SegmentStore:
+    """
+    Stores small objects as records in append-only segment files.
+
+    Every process appends to its own active segment, which it holds an exclusive flock on, and starts a new one after
+    *segment_size* bytes. Records are self-describing (header, key, data); the index of (segment, offset, length, etag)
+    per key is a SQLite database next to the segments, shared by all processes. Deleted and overwritten records stay in
+    their segment until compact() rewrites it.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS objects (
+        key TEXT PRIMARY KEY,
+        segment TEXT NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        etag TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS objects_segment ON objects (segment);
+    """
+
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_pid = None
+        self._offset = 0
+        self._db().executescript(self.SCHEMA)
+
+    def _db(self) -> sqlite3.Connection:
+        try:
+            return self._local.connection
+        except AttributeError:
+            connection = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            self._local.connection = connection
+            return connection
+
+    def _path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    def _open_segment(self):
+        segment = '{}-{}.seg'.format(os.getpid(), uuid.uuid4().hex)
+        fd = os.open(self._path(segment), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self._active = (segment, fd)
+        self._active_pid = os.getpid()
+        self._offset = 0
+
+    def _append(self, key: str, data: bytes, etag: int) -> Tuple[str, int]:
+        """Append a record to the active segment, return (segment, offset of the data)."""
+        encoded_key = key.encode()
+        record = RECORD_HEADER.pack(RECORD_MAGIC, len(encoded_key), len(data), etag) + encoded_key + data
+        with self._lock:
+            # after a fork the active segment belongs to the parent
+            if self._active is None or self._active_pid != os.getpid() or self._offset >= self.segment_size:
+                if self._active is not None and self._active_pid == os.getpid():
+                    os.close(self._active[1])
+                self._open_segment()
+            segment, fd = self._active
+            view = memoryview(record)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+            offset = self._offset + len(record) - len(data)
+            self._offset += len(record)
+        return segment, offset
+
+    def put(self, key: str, local_file) -> Tuple[str, int]:
+        """Store the contents of *local_file* as *key*, return (etag, size)."""
+        with open(local_file, 'rb') as file:
+            data = file.read()
+        etag = time.time_ns()
+        segment, offset = self._append(key, data, etag)
+        self._db().execute('INSERT OR REPLACE INTO objects (key, segment, offset, length, etag) '
+                           'VALUES (?, ?, ?, ?, ?)', (key, segment, offset, len(data), str(etag)))
+        return str(etag), len(data)
+
+    def get(self, key: str) -> Union[Tuple[str, int, int, str], None]:
+        """Return (segment, offset, length, etag) of *key*, or None if it isn't stored."""
+        return self._db().execute('SELECT segment, offset, length, etag FROM objects WHERE key = ?',
+                                  (key,)).fetchone()
+
+    def open(self, key: str) -> Union[Tuple[SegmentReader, int, str], None]:
+        """Return (reader, length, etag) of *key*, or None if it isn't stored."""
+        for _ in range(3):
+            location = self.get(key)
+            if location is None:
+                return None
+            segment, offset, length, etag = location
+            try:
+                fd = os.open(self._path(segment), os.O_RDONLY)
+            except FileNotFoundError:
+                continue  # compacted meanwhile
+            return SegmentReader(fd, offset, length), length, etag
+        raise FileNotFoundError(key)
+
+    def delete(self, key: str) -> int:
+        """Forget *key*, return its size (0 if it wasn't stored)."""
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT length FROM objects WHERE key = ?', (key,)).fetchone()
+            db.execute('DELETE FROM objects WHERE key = ?', (key,))
+        finally:
+            db.execute('COMMIT')
+        return row[0] if row else 0
+
+    def list(self, prefix: str) -> Iterator[Tuple[str, int, str]]:
+        """Yield (key, length, etag) of every key starting with *prefix*/."""
+        # '0' is the character after '/'
+        yield from self._db().execute('SELECT key, length, etag FROM objects WHERE key >= ? AND key < ?',
+                                      (prefix + '/', prefix + '0'))
+
+    def compact(self, garbage) -> int:
+        """
+        Rewrite sealed segments of which at least the fraction *garbage* is deleted data, return the bytes reclaimed.
+
+        Live records are appended to the active segment and moved in the index only if they weren't overwritten or
+        deleted meanwhile. Active segments (still flocked by their process) are skipped.
+        """
+        reclaimed = 0
+        for segment in sorted(os.listdir(self.directory)):
+            if not segment.endswith('.seg'):
+                continue
+            try:
+                fd = os.open(self._path(segment), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # active
+                size = os.fstat(fd).st_size
+                live, = self._db().execute('SELECT coalesce(sum(length), 0) FROM objects WHERE segment = ?',
+                                           (segment,)).fetchone()
+                if size and (size - live) / size < garbage:
+                    continue
+                self._rewrite(segment, fd)
+                remaining, = self._db().execute('SELECT count(*) FROM objects WHERE segment = ?',
+                                                (segment,)).fetchone()
+                if not remaining:
+                    os.unlink(self._path(segment))
+                    reclaimed += size - live
+            finally:
+                os.close(fd)
+        return reclaimed
+
+    def _rewrite(self, segment, fd):
+        rows = self._db().execute('SELECT key, offset, length, etag FROM objects WHERE segment = ?',
+                                  (segment,)).fetchall()
+        for key, offset, length, etag in rows:
+            data = os.pread(fd, length, offset)
+            new_segment, new_offset = self._append(key, data, int(etag))
+            self._db().execute('UPDATE objects SET segment = ?, offset = ? WHERE key = ? AND segment = ? AND offset = ?',
+                               (new_segment, new_offset, key, segment, offset))
+
+
+class PackedLocalTransfer(LocalTransfer):
+    """
+    Local storage packing files up to *threshold* bytes into segment files (see SegmentStore), larger files are
+    stored like LocalTransfer does.
+
+    Etags are nanosecond timestamps either way.
+    """
+
+    def __init__(self, basedir, cache, threshold=None, segment_size=None):
+        super().__init__(basedir, cache)
+        self.threshold = options.local_pack_threshold if threshold is None else threshold
+        self.segments = SegmentStore(os.path.join(basedir, '.segments'),
+                                     options.local_pack_segment_size if segment_size is None else segment_size)
+
+    def store(self, storage_object: StorageObject, stored_size=None) -> Tuple[StorageObject, int]:
+        if os.path.getsize(storage_object.local_file) > self.threshold:
+            new_object, size_diff = super().store(storage_object, stored_size)
+            self.segments.delete(file_key(storage_object))
+            return new_object, size_diff
+        old_size = self._stored_size(storage_object, stored_size)
+        etag, size = self.segments.put(file_key(storage_object), storage_object.local_file)
+        for path in self._paths(storage_object):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        new_object = storage_object._replace(size=size, etag=etag)
+        self._to_cache(new_object)
+        return new_object, size - old_size
+
+    def copy(self, source: StorageObject, destination: StorageObject):
+        if self.segments.get(file_key(source)) is not None:
+            return AbstractTransfer.copy(self, source, destination)
+        new_object, size_diff = super().copy(source, destination)
+        self.segments.delete(file_key(destination))
+        return new_object, size_diff
+
+    def retrieve(self, storage_object: StorageObject):
+        try:
+            cached = self._from_cache(storage_object)
+        except KeyError:
+            pass
+        else:
+            if cached.etag == storage_object.etag:
+                return storage_object._replace(fd=None)
+        packed = self.segments.open(file_key(storage_object))
+        if packed is None:
+            return super().retrieve(storage_object)
+        reader, size, etag = packed
+        if etag == storage_object.etag:
+            reader.close()
+            return storage_object._replace(fd=None)
+        return storage_object._replace(size=size, etag=etag, fd=reader)
+
+    def meta(self, storage_object: StorageObject):
+        try:
+            return self._from_cache(storage_object)
+        except KeyError:
+            pass
+        location = self.segments.get(file_key(storage_object))
+        if location is None:
+            return super().meta(storage_object)
+        _, _, size, etag = location
+        meta_object = storage_object._replace(size=size, etag=etag)
+        self._to_cache(meta_object)
+        return meta_object
+
+    def delete(self, storage_object: StorageObject, stored_size=None):
+        packed_size = self.segments.delete(file_key(storage_object))
+        size = super().delete(storage_object)
+        self._drop_from_cache(storage_object)
+        return packed_size or size
+
+    def list_objects(self, prefix):
+        yield from super().list_objects(prefix)
+        key_prefix = prefix + '/'
+        for key, size, etag in self.segments.list(prefix):
+            yield StorageObject(prefix, key[len(key_prefix):], etag=etag, size=size)
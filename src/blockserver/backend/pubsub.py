@@ -1,4 +1,6 @@
 from __future__ import annotations
+import asyncio
+
 import aioredis
 from tornado import ioloop
 
@@ -76,3 +78,12 @@ async def redis_publish(connection_pool: aioredis.Redis, channel, message):
         as_json = json.dumps(message)
         await connection.execute('publish', channel, as_json)
     monitoring.PUBSUB_PUBLISHED.inc()
+
+
+async def redis_publish_many(connection_pool: aioredis.Redis, messages):
+    """Publish many (channel, message) pairs, pipelined on one connection."""
+    import json
+    with await connection_pool as connection:
+        await asyncio.gather(*(connection.execute('publish', channel, json.dumps(message))
+                               for channel, message in messages))
+    monitoring.PUBSUB_PUBLISHED.inc(len(messages))
@@ -3,6 +3,8 @@ class QuotaPolicy:
 
     METAFILE_THRESHOLD = 150 * 1024
     TRAFFIC_THRESHOLD = 100 * 1024**3
+    # Cached usage is only trusted below this fraction of the quota, above it the database is asked.
+    HEADROOM = 0.9
 
     @staticmethod
     def upload(quota_reached, file_size, is_block, is_overwrite=False):
@@ -12,3 +14,7 @@ class QuotaPolicy:
             return False
         return is_overwrite and file_size < QuotaPolicy.METAFILE_THRESHOLD
 
+    @staticmethod
+    def has_headroom(used, amount, quota):
+        # without a quota there is nothing to spare
+        return quota > 0 and used + amount <= quota * QuotaPolicy.HEADROOM
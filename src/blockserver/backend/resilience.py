@@ -0,0 +1,132 @@
+from __future__ import annotations
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+
+from blockserver import monitoring as mon
+
+logger = logging.getLogger(__name__)
+
+# Error codes S3 (and AWS in general) answer with when requests should slow down
+THROTTLING_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests'}
+
+
+class DeadlineExceeded(Exception):
+    """No request slot became free before the deadline of an operation."""
+
+
+def classify(error):
+    """Return (retryable, throttled) for an *error* raised by a request."""
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        throttled = code in THROTTLING_CODES or status in (429, 503)
+        return throttled or status >= 500, throttled
+    # connection failures and timeouts
+    return isinstance(error, (BotoConnectionError, HTTPClientError)), False
+
+
+class ConcurrencyLimiter:
+    """
+    Limits the number of concurrent requests with additive increase, multiplicative decrease (AIMD).
+
+    Every successful request raises the limit by 1/limit (one per limit's worth of requests), a throttled request halves
+    it, at most once per *cooldown* seconds since the requests in flight at that time will likely be throttled as well.
+    """
+
+    DECREASE = 0.5
+
+    def __init__(self, maximum, minimum=1, cooldown=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+        mon.S3_CONCURRENCY_LIMIT.set(self.limit)
+
+    def acquire(self, deadline):
+        """Wait for a request slot, raise DeadlineExceeded if none is free before *deadline* (time.monotonic())."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            mon.S3_IN_FLIGHT.set(self.in_flight)
+
+    def try_acquire(self):
+        """Take a request slot if one is free right now, return whether it did."""
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            mon.S3_IN_FLIGHT.set(self.in_flight)
+            return True
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.DECREASE)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            mon.S3_IN_FLIGHT.set(self.in_flight)
+            mon.S3_CONCURRENCY_LIMIT.set(self.limit)
+            self._condition.notify_all()
+
+
+class Retrier:
+    """
+    Calls requests within a concurrency *limiter*, retrying throttled, failed (5xx) and timed out requests up to
+    *attempts* times in total.
+
+    Retries back off with decorrelated jitter (a random delay between *base* and three times the previous one, at most
+    *cap* seconds), so throttled clients don't retry in lockstep. An operation gives up once *deadline* seconds have
+    passed: no attempt is started later, and the last error is raised (DeadlineExceeded while waiting for a slot).
+    """
+
+    def __init__(self, limiter, attempts, deadline, base=0.05, cap=5):
+        self.limiter = limiter
+        self.attempts = attempts
+        self.deadline = deadline
+        self.base = base
+        self.cap = cap
+
+    def call(self, operation, function):
+        deadline = time.monotonic() + self.deadline
+        delay = self.base
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.limiter.acquire(deadline)
+            except DeadlineExceeded:
+                mon.S3_DEADLINES_EXCEEDED.labels(operation).inc()
+                raise
+            throttled = False
+            try:
+                return function()
+            except Exception as e:
+                retryable, throttled = classify(e)
+                if not retryable or attempt >= self.attempts:
+                    raise
+                delay = min(self.cap, random.uniform(self.base, delay * 3))
+                if time.monotonic() + delay >= deadline:
+                    mon.S3_DEADLINES_EXCEEDED.labels(operation).inc()
+                    raise
+                reason = 'throttled' if throttled else 'error'
+                mon.S3_RETRIES.labels(operation, reason).inc()
+                logger.warning('Retrying %s request in %.2f seconds (attempt %d, %s): %s',
+                               operation, delay, attempt, reason, e)
+            finally:
+                self.limiter.release(throttled)
+            time.sleep(delay)
@@ -0,0 +1,225 @@
+from __future__ import annotations
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Tuple
+from urllib.parse import quote, unquote
+
+from tornado.options import define, options
+
+from blockserver import monitoring as mon
+from blockserver.backend.transfer import AbstractTransfer, LocalTransfer, S3Transfer, StorageObject, file_key
+
+define('s3_staging', help='Acknowledge uploads once they are stored in this directory and replicate them to S3 '
+                          'in the background', default='')
+define('s3_staging_workers', help='Number of concurrent replications to S3', default=4)
+
+logger = logging.getLogger(__name__)
+
+
+def md5_etag(path, sync=False) -> str:
+    """Return the etag S3 assigns to the contents of *path* (when uploaded with a single PUT), optionally fsync it."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+        if sync:
+            os.fsync(file.fileno())
+    return '"{}"'.format(digest.hexdigest())
+
+
+def fsync_directory(path):
+    """Make the creation, renaming and removal of files in the directory *path* durable."""
+    fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def marker_lock(path):
+    """
+    Create the marker file *path* and hold an exclusive flock on it, yield *path*.
+
+    The marker may be removed while locked; whoever waited for the lock then retries with a new marker.
+    """
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        # the marker was removed while we waited for the lock
+        os.close(fd)
+    try:
+        yield path
+    finally:
+        os.close(fd)
+
+
+class StagingTransfer(AbstractTransfer):
+    """
+    Write-back transfer: uploads are committed to a local staging directory and replicated to S3 in the background.
+
+    Objects are served from the staging directory until they are replicated. Every staged object has a marker in the
+    pending directory, which also serves as a lock serializing staging, replication and deletion of that object.
+    Markers left over by a crash are picked up again on startup.
+
+    Etags are the MD5 of the content, i.e. what S3 reports for an object uploaded with a single PUT, so they don't
+    change when an object is replicated.
+    """
+
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 300
+
+    def __init__(self, directory, cache, remote: AbstractTransfer = None):
+        super().__init__(cache)
+        directory = Path(directory)
+        self.staging = LocalTransfer(str(directory / 'objects'), cache, fanout=0)
+        self.s3 = remote if remote is not None else S3Transfer(cache)
+        self.pending = directory / 'pending'
+        self.pending.mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(options.s3_staging_workers)
+        self._recover()
+
+    def _staged_path(self, storage_object: StorageObject) -> Path:
+        return self.staging.basepath / file_key(storage_object)
+
+    def _marker_path(self, storage_object: StorageObject) -> Path:
+        return self.pending / quote(file_key(storage_object), safe='')
+
+    def _pending_lock(self, storage_object: StorageObject):
+        """Create and lock the pending marker of *storage_object*, yield its path."""
+        return marker_lock(str(self._marker_path(storage_object)))
+
+    def _recover(self):
+        for marker in os.listdir(str(self.pending)):
+            prefix, file_path = unquote(marker).split('/', 1)
+            logger.info('Resuming replication of %s/%s', prefix, file_path)
+            self._enqueue(StorageObject(prefix, file_path))
+
+    def _enqueue(self, storage_object: StorageObject, attempt=0):
+        mon.STAGING_PENDING.inc()
+        self._executor.submit(self._replicate, storage_object, attempt)
+
+    def _replicate(self, storage_object: StorageObject, attempt):
+        try:
+            with self._pending_lock(storage_object) as marker:
+                staged = self._staged_path(storage_object)
+                if staged.exists():
+                    self._upload(storage_object._replace(local_file=str(staged)))
+                    self._replicated(storage_object, staged)
+                os.unlink(marker)
+        except Exception:
+            attempt += 1
+            delay = min(self.RETRY_DELAY * 2 ** attempt, self.MAX_RETRY_DELAY)
+            logger.exception('Replicating %s failed (attempt %d), retrying in %d seconds',
+                             file_key(storage_object), attempt, delay)
+            mon.STAGING_FAILURES.inc()
+            threading.Timer(delay, self._enqueue, (storage_object, attempt)).start()
+        finally:
+            mon.STAGING_PENDING.dec()
+
+    def _upload(self, storage_object: StorageObject):
+        # Failed requests are retried by the remote (see S3Transfer), a failed upload by _replicate, with a delay
+        # that doesn't hold a worker. The size difference isn't needed, don't ask S3 for it.
+        self.s3.store(storage_object, stored_size=0)
+
+    def _replicated(self, storage_object: StorageObject, staged: Path):
+        """Called (with the pending lock held) once the staged object is in S3."""
+        staged.unlink()
+        # before the marker is removed, a staged file without a marker would never be cleaned up
+        fsync_directory(staged.parent)
+
+    def store(self, storage_object: StorageObject, stored_size=None) -> Tuple[StorageObject, int]:
+        old_size = self._stored_size(storage_object, stored_size)
+        new_size = os.path.getsize(storage_object.local_file)
+        etag = md5_etag(storage_object.local_file, sync=True)
+        target_path = self._staged_path(storage_object)
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self._pending_lock(storage_object):
+            self.staging.move_or_copy(storage_object.local_file, str(target_path))
+            # the upload is acknowledged once both survive a crash
+            fsync_directory(target_path.parent)
+            fsync_directory(self.pending)
+
+        new_object = storage_object._replace(local_file=str(target_path), size=new_size, etag=etag)
+        self._to_cache(new_object)
+        self._enqueue(new_object)
+        return new_object, new_size - old_size
+
+    def upload_directory(self, storage_object: StorageObject):
+        return self.staging.upload_directory(storage_object)
+
+    def retrieve(self, storage_object: StorageObject):
+        try:
+            cached = self._from_cache(storage_object)
+        except KeyError:
+            cached = None
+        else:
+            if cached.etag == storage_object.etag:
+                return storage_object._replace(fd=None)
+        try:
+            fd = self._staged_path(storage_object).open('rb')
+        except FileNotFoundError:
+            return self.s3.retrieve(storage_object)
+        if cached is None:
+            cached = self._staged_meta(storage_object, fd.name)
+            if cached.etag == storage_object.etag:
+                fd.close()
+                return storage_object._replace(fd=None)
+        return cached._replace(fd=fd)
+
+    def _staged_meta(self, storage_object: StorageObject, path):
+        meta_object = storage_object._replace(size=os.path.getsize(path), etag=md5_etag(path))
+        self._to_cache(meta_object)
+        return meta_object
+
+    def meta(self, storage_object: StorageObject):
+        try:
+            return self._from_cache(storage_object)
+        except KeyError:
+            pass
+        try:
+            return self._staged_meta(storage_object, str(self._staged_path(storage_object)))
+        except FileNotFoundError:
+            return self.s3.meta(storage_object)
+
+    def delete(self, storage_object: StorageObject, stored_size=None) -> int:
+        with self._pending_lock(storage_object) as marker:
+            staged = self._staged_path(storage_object)
+            try:
+                size = staged.stat().st_size
+                staged.unlink()
+            except FileNotFoundError:
+                size = 0
+            else:
+                # otherwise the marker left by a crash would replicate the deleted object again
+                fsync_directory(staged.parent)
+            # an older version may be in S3, the staged one is the current one
+            s3_size = self.s3.delete(storage_object, stored_size)
+            os.unlink(marker)
+        self._drop_from_cache(storage_object)
+        return size or s3_size
+
+    def list_objects(self, prefix):
+        staged = {storage_object.file_path: storage_object for storage_object in self.staging.list_objects(prefix)}
+        for storage_object in self.s3.list_objects(prefix):
+            if storage_object.file_path not in staged:
+                yield storage_object
+        for storage_object in staged.values():
+            try:
+                yield self.meta(storage_object._replace(etag=None, size=None))
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
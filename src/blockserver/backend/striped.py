@@ -0,0 +1,208 @@
+from __future__ import annotations
+import hashlib
+import logging
+import math
+import os
+import shutil
+import tempfile
+from typing import List, Tuple
+
+from tornado.options import define, options
+
+from blockserver.backend.transfer import CAS_PREFIX, AbstractTransfer, LocalTransfer, StorageObject, file_key
+
+define('local_volumes', help='Spread locally stored files over these directories (path or path:weight, comma '
+                             'separated) instead of S3', multiple=True, default=[])
+define('local_volume_reserve', help='Fraction of a volume that is kept free, new files are placed on the next volume '
+                                    'once it fills up', default=0.05)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_volume(spec: str) -> Tuple[str, float]:
+    """Parse a volume specification ("path" or "path:weight")."""
+    path, _, weight = spec.rpartition(':')
+    if not path:
+        return spec, 1.0
+    try:
+        return path, float(weight)
+    except ValueError:
+        return spec, 1.0
+
+
+class StripedLocalTransfer(AbstractTransfer):
+    """
+    Spreads objects over several directories (volumes, usually on different disks).
+
+    Objects are placed by weighted rendezvous hashing of their file key: every volume gets a score per key and the
+    object goes to the volume with the highest score, unless that volume is full (see --local-volume-reserve), in which
+    case it goes to the next one. Adding a volume only moves the objects it now wins, see rebalance_prefix.
+
+    Volumes are identified by their path, which therefore must not change.
+    """
+
+    def __init__(self, volumes: List[str], cache, reserve=None):
+        super().__init__(cache)
+        self.volumes = []
+        self.weights = []
+        for spec in volumes:
+            path, weight = parse_volume(spec)
+            self.volumes.append(LocalTransfer(path, cache))
+            self.weights.append(weight)
+        self.reserve = options.local_volume_reserve if reserve is None else reserve
+
+    def _score(self, index, key):
+        digest = hashlib.md5('{}\0{}'.format(self.volumes[index].basepath, key).encode()).digest()
+        # uniform in (0, 1)
+        uniform = (int.from_bytes(digest[:8], 'big') + 1) / (2 ** 64 + 2)
+        return -self.weights[index] / math.log(uniform)
+
+    def _ranked(self, storage_object: StorageObject) -> List[LocalTransfer]:
+        """Return the volumes in placement order for *storage_object*."""
+        key = file_key(storage_object)
+        order = sorted(range(len(self.volumes)), key=lambda index: self._score(index, key), reverse=True)
+        return [self.volumes[index] for index in order]
+
+    def _has_room(self, volume: LocalTransfer, size):
+        try:
+            st = os.statvfs(str(volume.basepath))
+        except FileNotFoundError:
+            return True  # not created yet
+        return st.f_bavail * st.f_frsize - size > st.f_blocks * st.f_frsize * self.reserve
+
+    def _place(self, storage_object: StorageObject, size) -> LocalTransfer:
+        ranked = self._ranked(storage_object)
+        for volume in ranked:
+            if self._has_room(volume, size):
+                return volume
+        logger.warning('All volumes are full, storing %s on its preferred volume', file_key(storage_object))
+        return ranked[0]
+
+    def _find(self, storage_object: StorageObject):
+        """Return (volume, path, stat result) of *storage_object*, raise FileNotFoundError if it doesn't exist."""
+        for volume in self._ranked(storage_object):
+            try:
+                path, st = volume._stat(storage_object)
+            except FileNotFoundError:
+                continue
+            return volume, path, st
+        raise FileNotFoundError(file_key(storage_object))
+
+    def store(self, storage_object: StorageObject, stored_size=None) -> Tuple[StorageObject, int]:
+        old_size = self._stored_size(storage_object, stored_size)
+        new_size = os.path.getsize(storage_object.local_file)
+        target = self._place(storage_object, new_size)
+        new_object, _ = target.store(storage_object)
+        for volume in self.volumes:
+            if volume is not target:
+                volume.delete(storage_object)
+        # the other volumes dropped the entry
+        self._to_cache(new_object)
+        return new_object, new_size - old_size
+
+    def upload_directory(self, storage_object: StorageObject):
+        # The size isn't known yet: the first volume that isn't full, where the upload is most likely renamed into
+        # place (store() places it again once the size is known)
+        return self._place(storage_object, 0).upload_directory(storage_object)
+
+    def retrieve(self, storage_object: StorageObject):
+        try:
+            cached = self._from_cache(storage_object)
+        except KeyError:
+            pass
+        else:
+            if cached.etag == storage_object.etag:
+                return storage_object._replace(fd=None)
+        try:
+            volume, _, _ = self._find(storage_object)
+        except FileNotFoundError:
+            return None
+        return volume.retrieve(storage_object)
+
+    def meta(self, storage_object: StorageObject):
+        try:
+            return self._from_cache(storage_object)
+        except KeyError:
+            pass
+        try:
+            volume, _, _ = self._find(storage_object)
+        except FileNotFoundError:
+            return None
+        return volume.meta(storage_object)
+
+    def delete(self, storage_object: StorageObject, stored_size=None) -> int:
+        size = 0
+        for volume in self.volumes:
+            size = volume.delete(storage_object) or size
+        return size
+
+    def list_objects(self, prefix):
+        seen = set()
+        for volume in self.volumes:
+            for storage_object in volume.list_objects(prefix):
+                if storage_object.file_path not in seen:
+                    seen.add(storage_object.file_path)
+                    yield storage_object
+
+    def prefixes(self):
+        """Return the prefixes stored on any volume."""
+        prefixes = set()
+        for volume in self.volumes:
+            try:
+                entries = os.scandir(str(volume.basepath))
+            except FileNotFoundError:
+                continue
+            with entries:
+                prefixes.update(entry.name for entry in entries if entry.is_dir(follow_symlinks=False) and
+                                (not entry.name.startswith('.') or entry.name == CAS_PREFIX))
+        return sorted(prefixes)
+
+    def rebalance_prefix(self, prefix) -> int:
+        """
+        Move the objects of *prefix* that aren't on their preferred volume there, return the number moved.
+
+        Objects are copied next to their destination and linked into place, so a newer version stored concurrently is
+        never overwritten. The mtime (and therefore the etag) is preserved.
+        """
+        moved = 0
+        for volume in self.volumes:
+            for storage_object in list(volume.list_objects(prefix)):
+                ranked = self._ranked(storage_object)
+                target = self._place(storage_object, storage_object.size)
+                if ranked.index(target) >= ranked.index(volume):
+                    continue  # already on its volume, or only a worse one has room
+                if self._move(storage_object, volume, target):
+                    moved += 1
+        return moved
+
+    def _move(self, storage_object: StorageObject, source: LocalTransfer, target: LocalTransfer):
+        try:
+            source_path, st = source._stat(storage_object)
+        except FileNotFoundError:
+            return False
+        target_path = target._path(storage_object)
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=str(target.basepath), prefix='.rebalance-')
+        try:
+            with open(str(source_path), 'rb') as input_file, open(fd, 'wb') as output_file:
+                shutil.copyfileobj(input_file, output_file)
+                os.fsync(output_file.fileno())
+            os.utime(temporary, ns=(st.st_atime_ns, st.st_mtime_ns))
+            try:
+                os.link(temporary, str(target_path))
+            except FileExistsError:
+                # Either stored again since, or a leftover of an interrupted store: the newer one wins.
+                if os.stat(str(target_path)).st_mtime_ns < st.st_mtime_ns:
+                    os.replace(temporary, str(target_path))
+        finally:
+            try:
+                os.unlink(temporary)
+            except FileNotFoundError:
+                pass
+        try:
+            current = os.stat(str(source_path))
+        except FileNotFoundError:
+            return True
+        if (current.st_ino, current.st_mtime_ns) == (st.st_ino, st.st_mtime_ns):
+            os.unlink(str(source_path))
+        return True
@@ -0,0 +1,225 @@
+from __future__ import annotations
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Tuple
+from urllib.parse import quote
+
+from tornado.options import define, options
+
+from blockserver import monitoring as mon
+from blockserver.backend.staging import marker_lock, md5_etag
+from blockserver.backend.transfer import AbstractTransfer, LocalTransfer, S3Transfer, StorageObject, file_key
+
+define('tier_hot_dir', help='Keep recently used objects in this directory and demote the others to S3', default='')
+define('tier_cold_after', help='Demote objects not accessed for this many seconds', default=7 * 24 * 60 * 60)
+define('tier_hot_min_free', help='Fraction of the hot directory\'s file system that is kept free, by demoting the '
+                                 'least recently used objects', default=0.1)
+define('tier_promote_hits', help='Move objects back into the hot directory on this many reads since their demotion '
+                                 '(0: never)', default=2)
+define('tier_demote_interval', help='Seconds between demotion runs (0: only by the demote maintenance job)',
+       default=300)
+
+logger = logging.getLogger(__name__)
+
+
+class TieredTransfer(AbstractTransfer):
+    """
+    Two tier transfer: objects live in a local hot directory until they go cold, then they are demoted to S3.
+
+    Writes always go to the hot tier. Accesses are recorded in the cache (last access and count); a demotion run moves
+    objects that weren't accessed for --tier-cold-after seconds, or the least recently used ones while the hot tier is
+    short of space. A demoted object is promoted again on its --tier-promote-hits'th read.
+
+    Etags are the MD5 of the content in both tiers (like S3 assigns them), so moving objects between tiers doesn't
+    change them. Per object, storing, demoting, promoting and deleting are serialized by a flock on a marker file.
+    """
+
+    DEMOTE_BATCH = 1000
+    DEMOTE_LOCK = 'tier-demote'
+
+    def __init__(self, directory, cache, cold: AbstractTransfer = None):
+        super().__init__(cache)
+        directory = Path(directory)
+        self.hot = LocalTransfer(str(directory / 'objects'), cache, fanout=0)
+        self.cold = cold if cold is not None else S3Transfer(cache)
+        self.locks = directory / 'locks'
+        self.locks.mkdir(parents=True, exist_ok=True)
+        self._promotions = ThreadPoolExecutor(2)
+        if options.tier_demote_interval:
+            thread = threading.Thread(target=self._demote_periodically, name='tier-demote', daemon=True)
+            thread.start()
+
+    def _hot_path(self, storage_object: StorageObject) -> Path:
+        return self.hot.basepath / file_key(storage_object)
+
+    @contextmanager
+    def _lock(self, storage_object: StorageObject):
+        with marker_lock(str(self.locks / quote(file_key(storage_object), safe=''))) as marker:
+            try:
+                yield
+            finally:
+                os.unlink(marker)
+
+    def _hot_meta(self, storage_object: StorageObject, path):
+        meta_object = storage_object._replace(size=os.path.getsize(path), etag=md5_etag(path))
+        self._to_cache(meta_object)
+        return meta_object
+
+    def store(self, storage_object: StorageObject, stored_size=None) -> Tuple[StorageObject, int]:
+        old_size = self._stored_size(storage_object, stored_size)
+        new_size = os.path.getsize(storage_object.local_file)
+        etag = md5_etag(storage_object.local_file, sync=True)
+        target_path = self._hot_path(storage_object)
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock(storage_object):
+            self.hot.move_or_copy(storage_object.local_file, str(target_path))
+        new_object = storage_object._replace(local_file=str(target_path), size=new_size, etag=etag)
+        self._to_cache(new_object)
+        self.cache.forget_access(storage_object)
+        self.cache.record_access(storage_object, time.time())
+        return new_object, new_size - old_size
+
+    def upload_directory(self, storage_object: StorageObject):
+        return self.hot.upload_directory(storage_object)
+
+    def retrieve(self, storage_object: StorageObject):
+        try:
+            cached = self._from_cache(storage_object)
+        except KeyError:
+            cached = None
+        else:
+            if cached.etag == storage_object.etag:
+                return storage_object._replace(fd=None)
+        hits = self.cache.record_access(storage_object, time.time())
+        try:
+            fd = self._hot_path(storage_object).open('rb')
+        except FileNotFoundError:
+            pass
+        else:
+            mon.TIER_READS.labels('hot').inc()
+            if cached is None:
+                cached = self._hot_meta(storage_object, fd.name)
+            if cached.etag == storage_object.etag:
+                fd.close()
+                return storage_object._replace(fd=None)
+            return cached._replace(fd=fd)
+        mon.TIER_READS.labels('cold').inc()
+        if options.tier_promote_hits and hits >= options.tier_promote_hits:
+            self._promotions.submit(self.promote, storage_object)
+        return self.cold.retrieve(storage_object)
+
+    def meta(self, storage_object: StorageObject):
+        try:
+            return self._from_cache(storage_object)
+        except KeyError:
+            pass
+        try:
+            return self._hot_meta(storage_object, str(self._hot_path(storage_object)))
+        except FileNotFoundError:
+            return self.cold.meta(storage_object)
+
+    def delete(self, storage_object: StorageObject, stored_size=None) -> int:
+        with self._lock(storage_object):
+            try:
+                size = self._hot_path(storage_object).stat().st_size
+                self._hot_path(storage_object).unlink()
+            except FileNotFoundError:
+                size = 0
+            # an older version may be in the cold tier
+            cold_size = self.cold.delete(storage_object, stored_size)
+        self._drop_from_cache(storage_object)
+        self.cache.forget_access(storage_object)
+        return size or cold_size
+
+    def list_objects(self, prefix):
+        hot = {storage_object.file_path: storage_object for storage_object in self.hot.list_objects(prefix)}
+        for storage_object in self.cold.list_objects(prefix):
+            if storage_object.file_path not in hot:
+                yield storage_object
+        for storage_object in hot.values():
+            try:
+                yield self.meta(storage_object._replace(etag=None, size=None))
+            except FileNotFoundError:
+                pass
+
+    def promote(self, storage_object: StorageObject):
+        """Copy *storage_object* from the cold into the hot tier (it stays in the cold tier, too)."""
+        target_path = self._hot_path(storage_object)
+        with self._lock(storage_object):
+            if target_path.exists():
+                return
+            downloaded = self.cold.retrieve(storage_object._replace(etag=None))
+            if downloaded is None:
+                return
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=str(self.hot.basepath), prefix='.promote-')
+            try:
+                with open(fd, 'wb') as file:
+                    shutil.copyfileobj(downloaded.fd, file)
+                os.rename(temporary, str(target_path))
+            finally:
+                downloaded.fd.close()
+                if os.path.exists(temporary):
+                    os.unlink(temporary)
+        mon.TIER_PROMOTIONS.inc()
+
+    def _demote(self, storage_object: StorageObject, accessed):
+        """Move *storage_object* into the cold tier, unless it was accessed after *accessed*."""
+        with self._lock(storage_object):
+            hot_path = self._hot_path(storage_object)
+            if self.cache.get_last_access(storage_object) != accessed:
+                return False
+            if hot_path.exists():
+                # The cold tier may hold an older version, which can't be told apart through the shared cache.
+                self.cold.store(storage_object._replace(local_file=str(hot_path)), stored_size=0)
+                hot_path.unlink()
+                mon.TIER_DEMOTIONS.inc()
+            self.cache.forget_access(storage_object)
+        return True
+
+    def _short_of_space(self):
+        st = os.statvfs(str(self.hot.basepath))
+        return st.f_bavail < st.f_blocks * options.tier_hot_min_free
+
+    def demote(self) -> int:
+        """Demote cold objects (and the least recently used ones while short of space), return how many."""
+        token = self.cache.lock(self.DEMOTE_LOCK, options.tier_demote_interval or 3600)
+        if not token:
+            return 0  # another process is demoting
+        demoted = 0
+        try:
+            self.hot.basepath.mkdir(parents=True, exist_ok=True)
+            while True:
+                candidates = self.cache.get_least_recently_accessed(self.DEMOTE_BATCH)
+                cold_before = time.time() - options.tier_cold_after
+                progress = False
+                for key, accessed in candidates:
+                    if accessed > cold_before and not self._short_of_space():
+                        return demoted
+                    prefix, file_path = key.split('/', 1)
+                    if self._demote(StorageObject(prefix, file_path), accessed):
+                        demoted += 1
+                        progress = True
+                if not progress:
+                    return demoted
+        finally:
+            if not self.cache.unlock(self.DEMOTE_LOCK, token):
+                logger.warning('Demoting took longer than the demote lock is held')
+
+    def _demote_periodically(self):
+        while True:
+            time.sleep(options.tier_demote_interval)
+            try:
+                demoted = self.demote()
+            except Exception:
+                logger.exception('Demotion failed')
+            else:
+                if demoted:
+                    logger.info('Demoted %d objects', demoted)
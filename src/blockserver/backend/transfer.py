@@ -1,22 +1,53 @@
 from __future__ import annotations
-from typing import Tuple, Union, NamedTuple
+from typing import Iterator, Sequence, Tuple, Union, NamedTuple
 
 import boto3
 import errno
+import hashlib
 import logging
 import tempfile
 import os
 import shutil
+import time
+import uuid
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from tornado.options import define, options
 
 from blockserver import monitoring as mon
+from blockserver.backend.hedging import Hedger
+from blockserver.backend.objectcache import DiskObjectCache
+from blockserver.backend.resilience import ConcurrencyLimiter, Retrier
 
 define('s3_bucket', help='Name of S3 bucket', default='qabel')
+define('s3_connections', help='Size of the S3 connection pool (0: --transfers)', default=0)
+define('s3_key_fanout', help='Number of hex digits of the hash of an object S3 keys start with (0: <prefix>/<path> '
+                             'keys)', default=0)
+define('s3_key_flat_fallback', help='Also look for objects under their <prefix>/<path> key (while rekeying to '
+                                    '--s3-key-fanout)', default=False)
+define('s3_timeout', help='Seconds to wait for connecting to S3 and for each read from it', default=60)
+define('s3_attempts', help='Number of attempts of S3 requests failing with throttling, 5xx errors or timeouts',
+       default=5)
+define('s3_deadline', help='Seconds after which a failing S3 request is not retried anymore', default=60)
+define('s3_hedge_percentile', help='Send GET and HEAD requests to S3 a second time if they take longer than this '
+                                   'percentile of recent requests (0: never)', default=0)
+define('s3_hedge_budget', help='Maximum fraction of S3 GET and HEAD requests that are sent a second time',
+       default=0.05)
+define('s3_disk_cache', help='Cache objects downloaded from S3 in this directory', default='')
+define('s3_disk_cache_size', help='Maximum size of the S3 disk cache in bytes', default=10 * 1024**3)
+define('local_storage_fanout', help='Number of hash-derived directory levels objects of a prefix are spread over '
+                                    'by local storage', default=0)
+define('local_storage_flat_fallback', help='Also look for objects in the flat layout (while migrating to '
+                                           '--local-storage-fanout)', default=False)
+
+logger = logging.getLogger(__name__)
 
 
 StorageObject = NamedTuple('StorageObject',
@@ -31,6 +62,10 @@ def file_key(storage_object: StorageObject):
     return '{}/{}'.format(storage_object.prefix, storage_object.file_path)
 
 
+# Prefix of deduplicated contents, stored under their digest. Prefixes of users can't contain dots.
+CAS_PREFIX = '.cas'
+
+
 
 class AbstractTransfer(ABC):
 
@@ -43,9 +78,18 @@ class AbstractTransfer(ABC):
     def _to_cache(self, storage_object: StorageObject) -> Union[StorageObject, None]:
         self.cache.set_storage(storage_object)
 
+    def _drop_from_cache(self, storage_object: StorageObject):
+        self.cache.delete_storage(storage_object)
+
     @abstractmethod
-    def store(self, storage_object: StorageObject) -> Tuple[StorageObject, int]:
-        pass
+    def store(self, storage_object: StorageObject, stored_size: int = None) -> Tuple[StorageObject, int]:
+        """
+        Store *storage_object*.local_file, return the stored StorageObject and the size difference to the object it
+        replaced.
+
+        *stored_size* is the size of the replaced object (0 if there is none) if the caller knows it, transfers that
+        would have to ask their backend use it instead.
+        """
 
     @abstractmethod
     def retrieve(self, storage_object: StorageObject) -> Union[StorageObject, None]:
@@ -56,45 +100,217 @@ class AbstractTransfer(ABC):
         """Retrieve file metadata, return StorageObject with size and etag set. Return None if the object doesn't exist."""
 
     @abstractmethod
-    def delete(self, storage_object: StorageObject) -> int:
-        pass
+    def delete(self, storage_object: StorageObject, stored_size: int = None) -> int:
+        """Delete *storage_object*, return its size. *stored_size* is like for store()."""
+
+    def _stored_size(self, storage_object: StorageObject, stored_size):
+        """Return the size of the object that *storage_object* replaces, *stored_size* if the caller knows it."""
+        if stored_size is not None:
+            return stored_size
+        stored_object = self.meta(storage_object)
+        return stored_object.size if stored_object else 0
+
+    def delete_many(self, storage_objects: Sequence[StorageObject]):
+        """
+        Delete *storage_objects*, whose sizes need no accounting anymore.
+
+        This deletes them one by one, transfers that can delete in batches override it.
+        """
+        for storage_object in storage_objects:
+            self.delete(storage_object, stored_size=0)
+
+    @abstractmethod
+    def list_objects(self, prefix: str) -> Iterator[StorageObject]:
+        """Yield a StorageObject with size and etag set for every object stored under *prefix*."""
+
+    def upload_directory(self, storage_object: StorageObject) -> Union[str, None]:
+        """
+        Return the directory to receive an upload of *storage_object* in before it is stored.
+
+        None means the default temporary directory.
+        """
+        return None
+
+    def copy(self, source: StorageObject, destination: StorageObject) -> Tuple[StorageObject, int]:
+        """
+        Copy *source* to *destination*, return like store().
+
+        Raise FileNotFoundError if *source* doesn't exist. This downloads and stores the object again, transfers that
+        can copy it in place override it.
+        """
+        retrieved = self.retrieve(source._replace(etag=None))
+        if retrieved is None:
+            raise FileNotFoundError(file_key(source))
+        with tempfile.NamedTemporaryFile(dir=self.upload_directory(destination)) as temp:
+            try:
+                shutil.copyfileobj(retrieved.fd, temp)
+            finally:
+                retrieved.fd.close()
+            temp.flush()
+            return self.store(destination._replace(local_file=temp.name))
 
 
 class S3Transfer(AbstractTransfer):
-    def __init__(self, cache):
+    """
+    Stores objects in the bucket --s3-bucket.
+
+    All transfer threads share one low-level client: unlike boto3 resources clients are thread-safe, and its connection
+    pool is sized for the threads (--s3-connections).
+
+    With *fanout* > 0 keys start with that many hex digits of the hash of the object (``3f/<prefix>/<file_path>``),
+    so the objects of a prefix are spread over the partitions of the bucket instead of sharing the request rate of one
+    key prefix. With *flat_fallback* objects are also looked up under their flat key (``<prefix>/<file_path>``), which
+    allows rekeying (see rekey_prefix) while serving; storing, deleting and rekeying an object are then serialized by
+    a lock in the cache.
+
+    Requests are retried and limited in concurrency by a Retrier (--s3-attempts, --s3-deadline), botocore's own retries
+    are disabled. With --s3-hedge-percentile GET and HEAD requests are hedged (see Hedger): a slow response then costs
+    a second request instead of the tail latency of S3.
+    """
+
+    # larger objects can only be copied in parts
+    MAX_COPY_SIZE = 5 * 1024**3
+    # keys per DeleteObjects request
+    MAX_DELETE_BATCH = 1000
+    REKEY_LOCK_TTL = 300
+
+    def __init__(self, cache, fanout=None, flat_fallback=None):
         super().__init__(cache)
-        self.s3 = boto3.resource('s3')
+        connections = options.s3_connections or options.transfers
+        config = Config(max_pool_connections=connections, connect_timeout=options.s3_timeout,
+                        read_timeout=options.s3_timeout, retries={'max_attempts': 0})
+        self.s3 = boto3.session.Session().client('s3', config=config)
+        self.retrier = Retrier(ConcurrencyLimiter(connections), options.s3_attempts, options.s3_deadline)
+        self.fanout = options.s3_key_fanout if fanout is None else fanout
+        self.flat_fallback = options.s3_key_flat_fallback if flat_fallback is None else flat_fallback
+        if options.s3_disk_cache:
+            self.disk_cache = DiskObjectCache(options.s3_disk_cache, options.s3_disk_cache_size)
+        else:
+            self.disk_cache = None
+        self.hedgers = {}
+        if options.s3_hedge_percentile:
+            # both requests of a hedge hold a thread and a connection
+            executor = ThreadPoolExecutor(2 * connections)
+            self.hedgers = {operation: Hedger(executor, operation, options.s3_hedge_percentile,
+                                              options.s3_hedge_budget, self.retrier.limiter)
+                            for operation in ('get', 'head')}
+
+    def _request(self, operation, function, discard=None):
+        """Return function(), a request to S3 of *operation* (get, head, put, copy, delete or list)."""
+        hedger = self.hedgers.get(operation)
+        if hedger is not None:
+            function = partial(hedger.call, function, discard)
+        return self.retrier.call(operation, partial(self._timed, function))
+
+    @staticmethod
+    def _timed(function):
+        with mon.SUMMARY_S3_REQUESTS.time():
+            return function()
+
+    def _delete_key(self, key):
+        self._request('delete', partial(self.s3.delete_object, Bucket=options.s3_bucket, Key=key))
+
+    def _put(self, key, local_file):
+        # opened for every attempt, a failed attempt may have read the file partially
+        with open(local_file, 'rb') as f_in:
+            return self.s3.put_object(Bucket=options.s3_bucket, Key=key, Body=f_in)
+
+    def _list_pages(self, **kwargs):
+        """Yield the pages of ListObjectsV2 responses for *kwargs*."""
+        kwargs['Bucket'] = options.s3_bucket
+        while True:
+            page = self._request('list', partial(self.s3.list_objects_v2, **kwargs))
+            yield page
+            if not page.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+    def _key(self, storage_object: StorageObject) -> str:
+        """Return the key *storage_object* is stored under."""
+        key = file_key(storage_object)
+        if not self.fanout:
+            return key
+        return hashlib.md5(key.encode()).hexdigest()[:self.fanout] + '/' + key
+
+    def _keys(self, storage_object: StorageObject):
+        """Return the keys *storage_object* may be found under, in lookup order."""
+        key = self._key(storage_object)
+        if self.fanout and self.flat_fallback:
+            return key, file_key(storage_object)
+        return key,
+
+    @contextmanager
+    def _rekey_lock(self, storage_object: StorageObject):
+        if not (self.fanout and self.flat_fallback):
+            yield
+            return
+        name = 'rekey-' + file_key(storage_object)
+        while True:
+            token = self.cache.lock(name, self.REKEY_LOCK_TTL)
+            if token:
+                break
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if not self.cache.unlock(name, token):
+                logger.warning('Rekey lock of %s expired while it was held', file_key(storage_object))
 
-    @mon.TIME_IN_TRANSFER_STORE.time()
-    def store(self, storage_object: StorageObject):
-        obj = self.s3.Object(options.s3_bucket, file_key(storage_object))
+    def _head_key(self, key):
+        """Return (etag, size) of the object stored under *key*, (None, 0) if there is none."""
         try:
-            cached = self._from_cache(storage_object)
+            response = self._request('head', partial(self.s3.head_object, Bucket=options.s3_bucket, Key=key))
+        except ClientError as e:
+            status = e.response['ResponseMetadata']['HTTPStatusCode']
+            if status == 404:
+                return None, 0
+            else:
+                raise
+        return response['ETag'], response['ContentLength']
+
+    def _head(self, storage_object: StorageObject):
+        """Return (etag, size) of the stored object, (None, 0) if it doesn't exist."""
+        for key in self._keys(storage_object):
+            etag, size = self._head_key(key)
+            if etag is not None:
+                return etag, size
+        return None, 0
+
+    def _stored_size(self, storage_object: StorageObject, stored_size):
+        if stored_size is not None:
+            return stored_size
+        try:
+            return self._from_cache(storage_object).size
         except KeyError:
-            with mon.SUMMARY_S3_REQUESTS.time():
-                _, size = self._get_meta_info(obj)
-        else:
-            size = cached.size
+            _, size = self._head(storage_object)
+            return size
 
+    @mon.TIME_IN_TRANSFER_STORE.time()
+    def store(self, storage_object: StorageObject, stored_size=None):
+        size = self._stored_size(storage_object, stored_size)
         new_size = os.path.getsize(storage_object.local_file)
 
-        with open(storage_object.local_file, 'rb') as f_in:
-            with mon.SUMMARY_S3_REQUESTS.time():
-                response = obj.put(Body=f_in)
+        with self._rekey_lock(storage_object):
+            keys = self._keys(storage_object)
+            response = self._request('put', partial(self._put, keys[0], storage_object.local_file))
+            for key in keys[1:]:
+                self._delete_key(key)
             size_diff = new_size - size
             new_object = storage_object._replace(etag=response['ETag'], size=new_size)
             self._to_cache(new_object)
             return new_object, size_diff
 
-    def _get_meta_info(self, obj):
-        try:
-            return obj.e_tag, obj.content_length
-        except ClientError as e:
-            status = e.response['ResponseMetadata']['HTTPStatusCode']
-            if status == 404:
-                return None, 0
-            else:
-                raise
+    def _get(self, storage_object: StorageObject):
+        """Return the GetObject response for *storage_object*, None if it doesn't exist."""
+        for key in self._keys(storage_object):
+            kwargs = {'IfNoneMatch': storage_object.etag} if storage_object.etag else {}
+            try:
+                return self._request('get', partial(self.s3.get_object, Bucket=options.s3_bucket, Key=key, **kwargs),
+                                     discard=lambda response: response['Body'].close())
+            except ClientError as e:
+                if e.response['ResponseMetadata']['HTTPStatusCode'] != 404:
+                    raise
+        return None
 
     @mon.TIME_IN_TRANSFER_RETRIEVE.time()
     def retrieve(self, storage_object: StorageObject):
@@ -105,53 +321,231 @@ class S3Transfer(AbstractTransfer):
         else:
             if cached.etag == storage_object.etag:
                 return storage_object._replace(fd=None)
-        obj = self.s3.Object(options.s3_bucket, file_key(storage_object))
-        with mon.SUMMARY_S3_REQUESTS.time():
-            try:
-                if storage_object.etag:
-                    response = obj.get(IfNoneMatch=storage_object.etag)
-                else:
-                    response = obj.get()
-            except ClientError as e:
-                status = e.response['ResponseMetadata']['HTTPStatusCode']
-                if status == 304:
-                    return storage_object._replace(fd=None)
-                else:
-                    return None
-            size = response['ContentLength']
-            return storage_object._replace(fd=response['Body'], etag=response['ETag'], size=size)
+            if self.disk_cache is not None:
+                fd = self.disk_cache.open(file_key(storage_object), cached.etag)
+                if fd is not None:
+                    return cached._replace(fd=fd)
+        try:
+            response = self._get(storage_object)
+        except ClientError as e:
+            status = e.response['ResponseMetadata']['HTTPStatusCode']
+            if status == 304:
+                return storage_object._replace(fd=None)
+            raise
+        if response is None:
+            return None
+        size = response['ContentLength']
+        fd = response['Body']
+        if self.disk_cache is not None:
+            fd = self.disk_cache.fill(file_key(storage_object), response['ETag'], size, fd)
+        return storage_object._replace(fd=fd, etag=response['ETag'], size=size)
 
     @mon.TIME_IN_TRANSFER_META.time()
     def meta(self, storage_object: StorageObject):
         try:
             cached = self._from_cache(storage_object)
         except KeyError:
-            with mon.SUMMARY_S3_REQUESTS.time():
-                obj = self.s3.Object(options.s3_bucket, file_key(storage_object))
-                etag, size = self._get_meta_info(obj)
-                if etag is not None:
-                    meta_object = storage_object._replace(size=size, etag=etag)
-                    self._to_cache(meta_object)
-                    return meta_object
+            etag, size = self._head(storage_object)
+            if etag is not None:
+                meta_object = storage_object._replace(size=size, etag=etag)
+                self._to_cache(meta_object)
+                return meta_object
         else:
             return cached
 
     @mon.TIME_IN_TRANSFER_DELETE.time()
-    def delete(self, storage_object):
-        obj = self.s3.Object(options.s3_bucket, file_key(storage_object))
-        with mon.SUMMARY_S3_REQUESTS.time():
-            _, size = self._get_meta_info(obj)
-        with mon.SUMMARY_S3_REQUESTS.time():
-            obj.delete()
+    def delete(self, storage_object, stored_size=None):
+        size = self._stored_size(storage_object, stored_size)
+        with self._rekey_lock(storage_object):
+            # The flat key goes first, so rekey_prefix can't move a deleted object back into place.
+            for key in reversed(self._keys(storage_object)):
+                self._delete_key(key)
+        self._drop_from_cache(storage_object)
         return size
 
+    def delete_many(self, storage_objects):
+        if self.fanout and self.flat_fallback:
+            # deletes are serialized with rekeying per object
+            return super().delete_many(storage_objects)
+        keys = [self._key(storage_object) for storage_object in storage_objects]
+        for start in range(0, len(keys), self.MAX_DELETE_BATCH):
+            batch = [{'Key': key} for key in keys[start:start + self.MAX_DELETE_BATCH]]
+            response = self._request('delete', partial(self.s3.delete_objects, Bucket=options.s3_bucket,
+                                                       Delete={'Objects': batch, 'Quiet': True}))
+            errors = response.get('Errors')
+            if errors:
+                raise IOError('Deleting {} of {} objects failed, first {Key}: {Code} {Message}'.format(
+                    len(errors), len(batch), **errors[0]))
+        for storage_object in storage_objects:
+            self._drop_from_cache(storage_object)
+
+    def _copy_key(self, source_key, key, size):
+        """Copy the object under *source_key* (of *size*) to *key*, return its etag."""
+        copy_source = {'Bucket': options.s3_bucket, 'Key': source_key}
+        if size <= self.MAX_COPY_SIZE:
+            response = self._request('copy', partial(self.s3.copy_object, Bucket=options.s3_bucket, Key=key,
+                                                     CopySource=copy_source))
+            return response['CopyObjectResult']['ETag']
+        # managed multipart copy, which doesn't return the etag
+        self._request('copy', partial(self.s3.copy, copy_source, options.s3_bucket, key))
+        etag, _ = self._head_key(key)
+        return etag
+
+    @mon.TIME_IN_TRANSFER_STORE.time()
+    def copy(self, source: StorageObject, destination: StorageObject):
+        source_object = self.meta(source)
+        if source_object is None:
+            raise FileNotFoundError(file_key(source))
+        old_object = self.meta(destination)
+        old_size = old_object.size if old_object else 0
+        for source_key in self._keys(source):
+            try:
+                with self._rekey_lock(destination):
+                    etag = self._copy_key(source_key, self._key(destination), source_object.size)
+                    if self.fanout and self.flat_fallback:
+                        self._delete_key(file_key(destination))
+                break
+            except ClientError as e:
+                if e.response['ResponseMetadata']['HTTPStatusCode'] != 404:
+                    raise
+        else:
+            raise FileNotFoundError(file_key(source))
+        new_object = destination._replace(etag=etag, size=source_object.size)
+        self._to_cache(new_object)
+        return new_object, source_object.size - old_size
+
+    def _list_key_prefix(self, key_prefix):
+        """Yield (key without *key_prefix*, etag, size) of every object whose key starts with *key_prefix*."""
+        for page in self._list_pages(Prefix=key_prefix):
+            for entry in page.get('Contents', ()):
+                yield entry['Key'][len(key_prefix):], entry['ETag'], entry['Size']
+
+    def _shards(self):
+        return ['{:0{}x}'.format(shard, self.fanout) for shard in range(16 ** self.fanout)] if self.fanout else ['']
+
+    def list_objects(self, prefix):
+        seen = set()
+        for shard in self._shards():
+            key_prefix = '{}/{}/'.format(shard, prefix) if shard else prefix + '/'
+            for file_path, etag, size in self._list_key_prefix(key_prefix):
+                seen.add(file_path)
+                yield StorageObject(prefix, file_path, etag=etag, size=size)
+        if self.fanout and self.flat_fallback:
+            for file_path, etag, size in self._list_key_prefix(prefix + '/'):
+                if file_path not in seen:
+                    yield StorageObject(prefix, file_path, etag=etag, size=size)
+
+    def flat_prefixes(self):
+        """Return the prefixes with objects under flat keys."""
+        shards = set(self._shards())
+        prefixes = []
+        for page in self._list_pages(Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', ()):
+                name = common_prefix['Prefix'].rstrip('/')
+                if name not in shards:
+                    prefixes.append(name)
+        return prefixes
+
+    def rekey_prefix(self, prefix) -> int:
+        """
+        Move the objects of *prefix* from their flat to their hashed keys, return the number of moved objects.
+
+        Requires *fanout* and *flat_fallback* (in every server as well). An object stored under its hashed key
+        meanwhile is newer, then only the flat key is deleted.
+        """
+        if not (self.fanout and self.flat_fallback):
+            raise ValueError('Rekeying requires a fanout and the flat fallback')
+        moved = 0
+        for file_path, _, size in self._list_key_prefix(prefix + '/'):
+            storage_object = StorageObject(prefix, file_path)
+            flat_key = file_key(storage_object)
+            with self._rekey_lock(storage_object):
+                if self._head_key(self._key(storage_object))[0] is None:
+                    try:
+                        self._copy_key(flat_key, self._key(storage_object), size)
+                    except ClientError as e:
+                        if e.response['ResponseMetadata']['HTTPStatusCode'] != 404:
+                            raise
+                        continue  # deleted meanwhile
+                    moved += 1
+                self._delete_key(flat_key)
+        return moved
+
 
 class LocalTransfer(AbstractTransfer):
+    """
+    Stores objects in a directory.
 
-    def __init__(self, basedir, cache):
+    With *fanout* > 0 the objects of a prefix are spread over that many levels of hash-derived subdirectories
+    (``<prefix>/@3f/@a2/<file_path>``), so directories stay small however many objects a prefix has. Shard directories
+    start with an @, which can't occur in file paths. With *flat_fallback* objects are also looked up in the flat
+    layout (``<prefix>/<file_path>``), which allows migrating (see migrate_prefix) while serving.
+    """
+
+    SHARD_MARK = '@'
+    UPLOAD_DIRECTORY = '.upload'
+    # Files in the upload directory that weren't written to for this long (seconds) were left by a crash
+    STALE_UPLOAD_AGE = 24 * 60 * 60
+
+    def __init__(self, basedir, cache, fanout=None, flat_fallback=None):
         super().__init__(cache)
         self.basepath = Path(basedir)
+        self.fanout = options.local_storage_fanout if fanout is None else fanout
+        self.flat_fallback = options.local_storage_flat_fallback if flat_fallback is None else flat_fallback
         self.logger = logging.getLogger("qabel-block.local-storage." + basedir)
+        self._remove_stale_uploads()
+
+    def _remove_stale_uploads(self):
+        """
+        Remove uploads a crash left in the upload directory. Other processes may share it, so only files that
+        weren't written to for STALE_UPLOAD_AGE are removed.
+        """
+        stale_before = time.time() - self.STALE_UPLOAD_AGE
+        try:
+            entries = os.scandir(str(self.basepath / self.UPLOAD_DIRECTORY))
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < stale_before:
+                        os.unlink(entry.path)
+                        self.logger.info('Removed stale upload %s', entry.name)
+                except FileNotFoundError:
+                    pass
+
+    def _flat_path(self, storage_object: StorageObject) -> Path:
+        return self.basepath / file_key(storage_object)
+
+    def _path(self, storage_object: StorageObject) -> Path:
+        """Return the path *storage_object* is stored at."""
+        if not self.fanout:
+            return self._flat_path(storage_object)
+        digest = hashlib.md5(storage_object.file_path.encode()).hexdigest()
+        shards = [self.SHARD_MARK + digest[2 * level:2 * level + 2] for level in range(self.fanout)]
+        return self.basepath.joinpath(storage_object.prefix, *shards, storage_object.file_path)
+
+    def _paths(self, storage_object: StorageObject):
+        """Return the paths *storage_object* may be found at, in lookup order."""
+        path = self._path(storage_object)
+        if self.fanout and self.flat_fallback:
+            return path, self._flat_path(storage_object)
+        return path,
+
+    def _stat(self, storage_object: StorageObject):
+        """Return (path, stat result) of *storage_object*, raise FileNotFoundError if it doesn't exist."""
+        for path in self._paths(storage_object):
+            try:
+                return path, path.stat()
+            except FileNotFoundError:
+                pass
+        raise FileNotFoundError(file_key(storage_object))
+
+    def upload_directory(self, storage_object: StorageObject) -> str:
+        # On the same file system as the objects, so store() renames uploads instead of copying them
+        directory = self.basepath / self.UPLOAD_DIRECTORY
+        directory.mkdir(parents=True, exist_ok=True)
+        return str(directory)
 
     def atomic_copy(self, source, destination):
         # If renaming doesn't work, make a real copy and rename(2) the temporary
@@ -185,16 +579,18 @@ class LocalTransfer(AbstractTransfer):
             else:
                 raise
 
-    def store(self, storage_object: StorageObject) -> Tuple[StorageObject, int]:
-        try:
-            old_size = self.meta(storage_object).size
-        except AttributeError:
-            old_size = 0
+    def store(self, storage_object: StorageObject, stored_size=None) -> Tuple[StorageObject, int]:
+        old_size = self._stored_size(storage_object, stored_size)
         new_size = os.path.getsize(storage_object.local_file)
-        target_path = self.basepath / file_key(storage_object)
+        target_path = self._path(storage_object)
         target_path.parent.mkdir(parents=True, exist_ok=True)
 
         etag = self.move_or_copy(storage_object.local_file, str(target_path))
+        for path in self._paths(storage_object)[1:]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
 
         new_object = storage_object._replace(
             local_file=str(target_path),
@@ -212,9 +608,8 @@ class LocalTransfer(AbstractTransfer):
             if cached.etag == storage_object.etag:
                 return storage_object._replace(fd=None)
 
-        path = self.basepath / file_key(storage_object)
         try:
-            st = path.stat()
+            path, st = self._stat(storage_object)
         except FileNotFoundError:
             return None
         object = storage_object._replace(size=st.st_size, etag=str(st.st_mtime_ns))
@@ -227,9 +622,8 @@ class LocalTransfer(AbstractTransfer):
         try:
             cached = self._from_cache(storage_object)
         except KeyError:
-            path = self.basepath / file_key(storage_object)
             try:
-                st = path.stat()
+                _, st = self._stat(storage_object)
             except FileNotFoundError:
                 return None
             object = storage_object._replace(size=st.st_size, etag=str(st.st_mtime_ns))
@@ -238,14 +632,130 @@ class LocalTransfer(AbstractTransfer):
         else:
             return cached
 
-    def delete(self, storage_object: StorageObject):
-        path = self.basepath / file_key(storage_object)
+    def delete(self, storage_object: StorageObject, stored_size=None):
+        size = 0
+        # The flat path goes first, so migrate_prefix can't move a deleted object back into place.
+        for path in reversed(self._paths(storage_object)):
+            try:
+                st = path.stat()
+                path.unlink()
+            except OSError:
+                continue  # doesn't exist or raced delete
+            size = size or st.st_size
+        if size:
+            self._drop_from_cache(storage_object)
+        return size
+
+    def copy(self, source: StorageObject, destination: StorageObject):
+        """
+        Hard link *source* to *destination* (objects are replaced, never changed in place), or copy it if linking
+        isn't possible.
+        """
         try:
-            st = path.stat()
+            source_path, _ = self._stat(source)
         except FileNotFoundError:
-            return 0
+            return super().copy(source, destination)
+        old_object = self.meta(destination)
+        old_size = old_object.size if old_object else 0
+        target_path = self._path(destination)
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = os.path.join(self.upload_directory(destination), '.copy-' + uuid.uuid4().hex)
         try:
-            path.unlink()
-        except OSError:
-            return 0  # raced delete
-        return st.st_size
+            try:
+                os.link(str(source_path), temporary)
+            except OSError as os_error:
+                if os_error.errno not in [errno.ENOTSUP, errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                    raise
+                # an in-kernel copy, shutil uses sendfile(2) or copy_file_range(2)
+                shutil.copyfile(str(source_path), temporary)
+            st = os.stat(temporary)
+            os.rename(temporary, str(target_path))
+        finally:
+            try:
+                os.unlink(temporary)
+            except FileNotFoundError:
+                pass
+        for path in self._paths(destination)[1:]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        new_object = destination._replace(local_file=str(target_path), size=st.st_size, etag=str(st.st_mtime_ns))
+        self._to_cache(new_object)
+        return new_object, st.st_size - old_size
+
+    def _file_path(self, relative_path):
+        """Return the file path of the object at *relative_path* (relative to its prefix directory)."""
+        parts = relative_path.split(os.sep)
+        while parts[0].startswith(self.SHARD_MARK):
+            del parts[0]
+        return '/'.join(parts)
+
+    def list_objects(self, prefix):
+        root = str(self.basepath / prefix)
+        seen = set() if self.fanout and self.flat_fallback else None
+        directories = [root]
+        while directories:
+            try:
+                entries = os.scandir(directories.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        file_path = self._file_path(os.path.relpath(entry.path, root))
+                        if seen is not None:
+                            if file_path in seen:
+                                continue
+                            seen.add(file_path)
+                        try:
+                            if seen is None:
+                                st = entry.stat(follow_symlinks=False)
+                            else:
+                                # the sharded copy takes precedence
+                                st = self._stat(StorageObject(prefix, file_path))[1]
+                        except FileNotFoundError:
+                            continue
+                        yield StorageObject(prefix, file_path, etag=str(st.st_mtime_ns), size=st.st_size)
+
+    def migrate_prefix(self, prefix) -> int:
+        """
+        Move the objects of *prefix* from the flat layout into the sharded layout, return the number moved.
+
+        Safe to run while serving with flat_fallback enabled: objects are linked into place (which fails if a newer
+        version was stored meanwhile) before their flat path is removed.
+        """
+        if not self.fanout:
+            raise ValueError('migrating requires a sharded layout (fanout > 0)')
+        root = str(self.basepath / prefix)
+        moved = 0
+        directories = [root]
+        while directories:
+            try:
+                entries = os.scandir(directories.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith(self.SHARD_MARK):
+                            directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        file_path = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                        target = self._path(StorageObject(prefix, file_path))
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        try:
+                            os.link(entry.path, str(target))
+                        except FileExistsError:
+                            pass  # stored again since
+                        except FileNotFoundError:
+                            continue  # deleted since
+                        else:
+                            moved += 1
+                        try:
+                            os.unlink(entry.path)
+                        except FileNotFoundError:
+                            pass
+        return moved
@@ -5,6 +5,10 @@ from collections import namedtuple
 
 User = namedtuple('User', ['user_id', 'is_active', 'quota', 'traffic_quota'])
 
+ObjectInfo = namedtuple('ObjectInfo', ['path', 'size', 'etag', 'mtime', 'digest', 'checksum'])
+# digest is only set for deduplicated objects, checksum (SHA-256 of the content) if it is known
+ObjectInfo.__new__.__defaults__ = (None, None)
+
 
 def this_month():
     """Return datetime.date for the current month (day=1)."""
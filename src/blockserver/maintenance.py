@@ -0,0 +1,256 @@
+"""
+Maintenance jobs for the block server.
+
+They take the same options as the run.py script (a config file and/or command line options), followed by the job:
+
+    src$ python -m blockserver.maintenance [config file] [--options] <job>
+
+Jobs:
+
+    reconcile         Recount the storage used by every user from the storage backend and correct users.size.
+    migrate-layout    Move local storage objects from the flat into the sharded layout (--local-storage-fanout).
+    rebalance         Move objects to their preferred volume (--local-volumes), e.g. after adding a volume.
+    compact           Reclaim the space of deleted objects in segment files (--local-pack-threshold).
+    demote            Move cold objects from the hot tier to S3 (--tier-hot-dir).
+    rekey             Move S3 objects from their <prefix>/<path> to their hashed keys (--s3-key-fanout).
+    purge             Remove objects deleted with --deferred-deletes from the storage backend.
+"""
+from __future__ import annotations
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from tornado.options import define, options
+
+from blockserver import server
+from blockserver.backend import cache
+from blockserver.backend.database import PostgresUserDatabase
+from blockserver.backend.deletion import DeleteQueue
+from blockserver.backend.packing import PackedLocalTransfer
+from blockserver.backend.striped import StripedLocalTransfer
+from blockserver.backend.tiering import TieredTransfer
+from blockserver.backend.transfer import CAS_PREFIX, LocalTransfer, S3Transfer
+
+define('reconcile_workers', help="Number of prefixes walked concurrently by the reconcile job", default=32)
+define('reconcile_rate', help="Maximum number of objects per second counted by the reconcile job (0: unlimited)",
+       default=0)
+define('reconcile_state', help="File the reconcile job records its progress in, to resume after interruption",
+       default='reconcile.state')
+define('migrate_workers',
+       help="Number of prefixes migrated concurrently by the migrate-layout, rebalance and rekey jobs", default=8)
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket allowing *rate* operations per second (unlimited if *rate* is 0), shared by threads."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Going into debt lets batches larger than the bucket through, the debt is slept off.
+            self._tokens -= amount
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ProgressState:
+    """
+    Remembers the last user that was completely processed, so an interrupted job can resume after it.
+
+    Users are processed in ascending id order, hence a single id describes the progress.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                return int(file.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, user_id):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write(str(user_id))
+        os.rename(temporary, self.path)
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def count_prefix(transfer, prefix, limiter, batch=1000):
+    """Return the total size of all objects stored under *prefix*."""
+    total = count = 0
+    for storage_object in transfer.list_objects(prefix):
+        total += storage_object.size
+        count += 1
+        if count % batch == 0:
+            limiter.acquire(batch)
+    limiter.acquire(count % batch)
+    return total
+
+
+def reconcile(db, transfer, workers, limiter, state):
+    """
+    Recount the storage of every user and correct users.size where it drifted. Users whose size changed during their
+    recount are left for the next run, since the count may or may not include that change.
+
+    The prefixes of a window of users are walked concurrently, users are corrected (and the progress recorded) in
+    ascending id order. Returns the number of corrected users.
+    """
+    corrected = 0
+
+    def finish(user_id, expected, version, deduplicated, futures):
+        nonlocal corrected
+        actual = deduplicated + sum(future.result() for future in futures)
+        if actual != expected:
+            if db.correct_size(user_id, version, actual):
+                logger.info('User %d uses %d bytes, not %d', user_id, actual, expected)
+                corrected += 1
+            else:
+                logger.info('User %d stored or deleted objects while being recounted, not corrected', user_id)
+        state.save(user_id)
+
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        for user_id in db.get_user_ids(after=state.load()):
+            expected, version = db.get_size_snapshot(user_id)
+            prefixes = db.get_prefixes(user_id)
+            # deduplicated objects aren't stored under their prefix, the catalog knows their sizes
+            deduplicated = sum(db.get_deduplicated_size(prefix) for prefix in prefixes)
+            futures = [executor.submit(count_prefix, transfer, prefix, limiter) for prefix in prefixes]
+            pending.append((user_id, expected, version, deduplicated, futures))
+            while len(pending) > workers:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    state.clear()
+    return corrected
+
+
+def run_reconcile():
+    db = PostgresUserDatabase(psycopg2.connect(dsn=options.psql_dsn))
+    transfer = server.get_transfer_cls()(cache=cache.RedisCache(host=options.redis_host, port=options.redis_port))
+    corrected = reconcile(db, transfer, options.reconcile_workers, RateLimiter(options.reconcile_rate),
+                          ProgressState(options.reconcile_state))
+    logger.info('Corrected the storage usage of %d users', corrected)
+
+
+def migrate_layout(transfer: LocalTransfer, workers):
+    """Migrate every prefix of *transfer* into its sharded layout, return the number of moved objects."""
+    prefixes = [entry.name for entry in os.scandir(str(transfer.basepath))
+                if entry.is_dir(follow_symlinks=False) and (not entry.name.startswith('.') or entry.name == CAS_PREFIX)]
+    with ThreadPoolExecutor(workers) as executor:
+        return sum(executor.map(transfer.migrate_prefix, prefixes))
+
+
+def run_migrate_layout():
+    if not options.local_storage or not options.local_storage_fanout:
+        raise SystemExit('migrate-layout requires --local-storage and --local-storage-fanout')
+    transfer = LocalTransfer(options.local_storage, cache.RedisCache(host=options.redis_host, port=options.redis_port),
+                             flat_fallback=True)
+    moved = migrate_layout(transfer, options.migrate_workers)
+    logger.info('Moved %d objects into the sharded layout', moved)
+
+
+def rebalance(transfer: StripedLocalTransfer, workers):
+    """Rebalance every prefix of *transfer*, return the number of moved objects."""
+    with ThreadPoolExecutor(workers) as executor:
+        return sum(executor.map(transfer.rebalance_prefix, transfer.prefixes()))
+
+
+def run_rebalance():
+    if not options.local_volumes:
+        raise SystemExit('rebalance requires --local-volumes')
+    transfer = StripedLocalTransfer(options.local_volumes,
+                                    cache.RedisCache(host=options.redis_host, port=options.redis_port))
+    moved = rebalance(transfer, options.migrate_workers)
+    logger.info('Moved %d objects to their preferred volume', moved)
+
+
+def run_compact():
+    if not options.local_storage or not options.local_pack_threshold:
+        raise SystemExit('compact requires --local-storage and --local-pack-threshold')
+    transfer = PackedLocalTransfer(options.local_storage,
+                                   cache.RedisCache(host=options.redis_host, port=options.redis_port))
+    reclaimed = transfer.segments.compact(options.compact_garbage)
+    logger.info('Reclaimed %d bytes', reclaimed)
+
+
+def run_demote():
+    if not options.tier_hot_dir:
+        raise SystemExit('demote requires --tier-hot-dir')
+    options.tier_demote_interval = 0
+    transfer = TieredTransfer(options.tier_hot_dir, cache.RedisCache(host=options.redis_host, port=options.redis_port))
+    demoted = transfer.demote()
+    logger.info('Demoted %d objects', demoted)
+
+
+def rekey(transfer: S3Transfer, workers):
+    """Rekey every prefix of *transfer*, return the number of moved objects."""
+    with ThreadPoolExecutor(workers) as executor:
+        return sum(executor.map(transfer.rekey_prefix, transfer.flat_prefixes()))
+
+
+def run_rekey():
+    if not options.s3_key_fanout:
+        raise SystemExit('rekey requires --s3-key-fanout')
+    transfer = S3Transfer(cache.RedisCache(host=options.redis_host, port=options.redis_port), flat_fallback=True)
+    moved = rekey(transfer, options.migrate_workers)
+    logger.info('Moved %d objects to their hashed keys', moved)
+
+
+def run_purge():
+    cache_object = cache.RedisCache(host=options.redis_host, port=options.redis_port)
+    queue = DeleteQueue(PostgresUserDatabase(psycopg2.connect(dsn=options.psql_dsn)),
+                        server.get_transfer_cls()(cache=cache_object), cache_object)
+    purged = queue.purge()
+    logger.info('Removed %d deleted objects', purged)
+
+
+JOBS = {
+    'reconcile': run_reconcile,
+    'migrate-layout': run_migrate_layout,
+    'rebalance': run_rebalance,
+    'compact': run_compact,
+    'demote': run_demote,
+    'rekey': run_rekey,
+    'purge': run_purge,
+}
+
+
+def main(argv):
+    if len(argv) > 2 and not argv[1].startswith('--'):
+        options.parse_config_file(argv[1])
+        argv = argv[:1] + argv[2:]
+    args = options.parse_command_line(argv)
+    if len(args) != 1 or args[0] not in JOBS:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    JOBS[args[0]]()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
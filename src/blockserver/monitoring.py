@@ -21,6 +21,38 @@ TIME_IN_TRANSFER_DELETE = Histogram('block_wait_for_transfer_delete',
                                     'Time spent deleting a file')
 
 SUMMARY_S3_REQUESTS = Summary('block_s3_requests', 'Count and time of requests to s3')
+S3_CONCURRENCY_LIMIT = Gauge('block_s3_concurrency_limit', 'Current limit of concurrent S3 requests (AIMD)')
+S3_IN_FLIGHT = Gauge('block_s3_in_flight', 'Number of S3 requests in flight')
+S3_RETRIES = Counter('block_s3_retries', 'Number of retried S3 requests', ['operation', 'reason'])
+S3_DEADLINES_EXCEEDED = Counter('block_s3_deadlines_exceeded', 'Number of S3 operations given up at their deadline',
+                                ['operation'])
+S3_HEDGEABLE_REQUESTS = Counter('block_s3_hedgeable_requests',
+                                'Number of S3 requests that may be hedged (--s3-hedge-percentile)', ['operation'])
+S3_HEDGES = Counter('block_s3_hedges', 'Number of S3 requests that were sent a second time', ['operation'])
+S3_HEDGE_WINS = Counter('block_s3_hedge_wins', 'Number of hedged S3 requests answered first by the second request',
+                        ['operation'])
+
+DISK_CACHE_HITS = Counter('block_disk_cache_hits', 'Number of downloads served from the disk cache')
+DISK_CACHE_MISSES = Counter('block_disk_cache_misses', 'Number of downloads not found in the disk cache')
+DISK_CACHE_SIZE = Gauge('block_disk_cache_size', 'Bytes stored in the disk cache (approximately)')
+STAGING_PENDING = Gauge('block_staging_pending', 'Number of staged objects waiting for replication to S3')
+UNCHANGED_UPLOADS = Counter('block_unchanged_uploads',
+                            'Number of uploads not stored because the stored object has the same content')
+COPIES = Counter('block_copies', 'Number of objects copied or moved on the server', ['operation'])
+DEFERRED_DELETES = Counter('block_deferred_deletes',
+                           'Number of deletes whose removal from the storage backend was deferred')
+DELETES_PURGED = Counter('block_deletes_purged', 'Number of deferred deletes removed from the storage backend')
+REMOVAL_TIMEOUTS = Counter('block_removal_timeouts',
+                           'Number of stores answered with 503 because a removal of the object took too long')
+BULK_DELETED = Counter('block_bulk_deleted', 'Number of objects deleted by bulk deletes')
+BATCH_UPLOADED = Counter('block_batch_uploaded', 'Number of objects stored by batched uploads')
+ARCHIVED_OBJECTS = Counter('block_archived_objects', 'Number of objects downloaded in archives')
+SYNC_CHECKED = Counter('block_sync_checked', 'Number of objects checked by sync checks', ['result'])
+DEDUP_HITS = Counter('block_dedup_hits', 'Number of uploads whose content was already stored')
+TIER_READS = Counter('block_tier_reads', 'Number of objects read from the hot or cold tier', ['tier'])
+TIER_PROMOTIONS = Counter('block_tier_promotions', 'Number of objects moved into the hot tier')
+TIER_DEMOTIONS = Counter('block_tier_demotions', 'Number of objects moved into the cold tier')
+STAGING_FAILURES = Counter('block_staging_failures', 'Number of failed replications of staged objects to S3')
 
 REQ_RESPONSE = Histogram('block_response_time',
                          'Time to respond to a request')
@@ -31,6 +63,8 @@ CONTENT_LENGTH_ERROR = Counter('content_length_error', 'Number of requests that
 
 COUNT_AUTH_CACHE_HITS = Counter('block_auth_cache_hits', 'Number of cache hits for auth requests')
 COUNT_AUTH_CACHE_SETS = Counter('block_auth_cache_sets', 'Number of cache sets for auth requests')
+COUNT_QUOTA_CACHE_HITS = Counter('block_quota_cache_hits',
+                                 'Number of quota checks answered from the usage cache', ['type'])
 
 TRAFFIC_RESPONSE = Counter('block_traffic_response', 'Download traffic')
 TRAFFIC_REQUEST = Counter('block_traffic_request', 'Upload traffic')
@@ -38,6 +72,9 @@ TRAFFIC_REQUEST = Counter('block_traffic_request', 'Upload traffic')
 DB_WAIT_FOR_CONNECTIONS = Counter('block_wait_database_connections',
                                   'Seconds waited for getting a connection')
 
+DB_REPLICA_LAG = Gauge('block_database_replica_lag',
+                       'Replay lag of the read replicas in seconds', ['replica'])
+
 TRAFFIC_BY_REQUEST = Summary('block_traffic_by_request',
                              'Traffic by individual request')
 
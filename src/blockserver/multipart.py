@@ -0,0 +1,124 @@
+from __future__ import annotations
+from typing import Callable, Dict, Tuple
+
+from tornado.httputil import HTTPHeaders, HTTPInputError
+
+
+class MultipartError(ValueError):
+    """The body is not valid multipart/form-data."""
+
+
+def parse_options(value: str) -> Tuple[str, Dict[str, str]]:
+    """Split a header value like 'form-data; name="foo"' into ('form-data', {'name': 'foo'})."""
+    main, *params = value.split(';')
+    options = {}
+    for param in params:
+        key, sep, param_value = param.strip().partition('=')
+        if not sep:
+            continue
+        if len(param_value) >= 2 and param_value[0] == param_value[-1] == '"':
+            param_value = param_value[1:-1]
+        options[key.lower()] = param_value
+    return main.strip().lower(), options
+
+
+def boundary(content_type: str) -> bytes:
+    """Return the boundary of a multipart/form-data *content_type*."""
+    main, options = parse_options(content_type)
+    if main != 'multipart/form-data' or not options.get('boundary'):
+        raise MultipartError('Expected multipart/form-data with a boundary')
+    return options['boundary'].encode('latin1')
+
+
+class MultipartParser:
+    """
+    Incremental parser of multipart/form-data bodies, so parts don't have to be held in memory.
+
+    The body is fed in chunks of any size. For every part *open_part* is called with its headers and returns a file
+    object the content of the part is written to, *close_part* is called with that object when the part is complete.
+    """
+
+    MAX_HEADER_SIZE = 16 * 1024
+
+    PREAMBLE, DELIMITER, HEADERS, BODY, EPILOGUE = range(5)
+
+    def __init__(self, boundary: bytes, open_part: Callable, close_part: Callable):
+        self.open_part = open_part
+        self.close_part = close_part
+        self._delimiter = b'\r\n--' + boundary
+        # the first boundary isn't preceded by a line break
+        self._buffer = b'\r\n'
+        self._state = self.PREAMBLE
+        self._part = None
+
+    def feed(self, chunk: bytes):
+        self._buffer += chunk
+        while self._step():
+            pass
+
+    def _step(self):
+        """Parse as much of the buffer as possible for the current state, return whether to go on."""
+        buffer = self._buffer
+        if self._state == self.PREAMBLE:
+            index = buffer.find(self._delimiter)
+            if index < 0:
+                self._buffer = buffer[-len(self._delimiter):]
+                return False
+            self._buffer = buffer[index + len(self._delimiter):]
+            self._state = self.DELIMITER
+        elif self._state == self.DELIMITER:
+            if len(buffer) < 2:
+                return False
+            if buffer.startswith(b'--'):
+                self._buffer = b''
+                self._state = self.EPILOGUE
+                return False
+            # transport padding may follow the boundary
+            index = buffer.find(b'\r\n')
+            if index < 0 or buffer[:index].strip(b' \t'):
+                if index >= 0 or len(buffer) > self.MAX_HEADER_SIZE:
+                    raise MultipartError('Malformed boundary line')
+                return False
+            self._buffer = buffer[index + 2:]
+            self._state = self.HEADERS
+        elif self._state == self.HEADERS:
+            if buffer.startswith(b'\r\n'):
+                header_block, rest = b'', buffer[2:]
+            else:
+                index = buffer.find(b'\r\n\r\n')
+                if index < 0:
+                    if len(buffer) > self.MAX_HEADER_SIZE:
+                        raise MultipartError('Part headers too large')
+                    return False
+                header_block, rest = buffer[:index], buffer[index + 4:]
+            self._buffer = rest
+            try:
+                headers = HTTPHeaders.parse(header_block.decode('utf-8'))
+            # ValueError covers UnicodeDecodeError and what older tornado versions raise
+            except (HTTPInputError, ValueError) as e:
+                raise MultipartError('Malformed part headers: {}'.format(e))
+            self._part = self.open_part(headers)
+            self._state = self.BODY
+        elif self._state == self.BODY:
+            index = buffer.find(self._delimiter)
+            if index < 0:
+                # the end of the buffer may be the start of a delimiter
+                keep = len(self._delimiter) - 1
+                if len(buffer) > keep:
+                    self._part.write(buffer[:-keep])
+                    self._buffer = buffer[-keep:]
+                return False
+            self._part.write(buffer[:index])
+            self.close_part(self._part)
+            self._part = None
+            self._buffer = buffer[index + len(self._delimiter):]
+            self._state = self.DELIMITER
+        else:
+            self._buffer = b''
+            return False
+        return True
+
+    def finish(self):
+        """Check that the body was complete."""
+        if self._state != self.EPILOGUE:
+            raise MultipartError('Incomplete multipart body')
@@ -36,3 +36,70 @@ def test_auth_cache_old_data(cache):
     cache._set('some_token', user_id=3, is_active=0)
     with pytest.raises(KeyError):
         cache.get_auth('some_token')
+
+
+def test_usage_cache(cache):
+    with pytest.raises(KeyError):
+        cache.get_usage(0)
+    cache.incr_usage(0, 10)
+    with pytest.raises(KeyError):
+        cache.get_usage(0)
+    cache.set_usage(0, 100)
+    cache.incr_usage(0, -10)
+    assert cache.get_usage(0) == 90
+
+
+def test_traffic_and_owner_cache(cache):
+    with pytest.raises(KeyError):
+        cache.get_traffic(0)
+    cache.set_traffic(0, 5)
+    cache.incr_traffic(0, 5)
+    assert cache.get_traffic(0) == 10
+    with pytest.raises(KeyError):
+        cache.get_prefix_owner('foo')
+    cache.set_prefix_owner('foo', 3)
+    assert cache.get_prefix_owner('foo') == 3
+
+
+def test_usage_reservations(cache):
+    assert cache.reserve_usage(0, 10, 10, 100) is None
+    cache.set_usage(0, 80)
+    assert cache.reserve_usage(0, 10, 10, 100)
+    assert cache.reserve_usage(0, 10, 10, 100)
+    assert not cache.reserve_usage(0, 10, 10, 100)
+    cache.commit_usage(0, 10, 10)
+    cache.commit_usage(0, 10, 0)
+    assert cache.get_usage(0) == 90
+    assert cache.reserve_usage(0, 10, 10, 100)
+    assert not cache.reserve_usage(0, 1, 0, 100)
+
+
+def test_access_tracking(cache):
+    first, second = StorageObject('foo', 'first'), StorageObject('foo', 'second')
+    assert cache.get_last_access(first) is None
+    assert cache.record_access(first, 100) == 1
+    assert cache.record_access(second, 50) == 1
+    assert cache.record_access(first, 150) == 2
+    assert cache.get_last_access(first) == 150
+    assert cache.get_least_recently_accessed(10) == [('foo/second', 50), ('foo/first', 150)]
+    cache.forget_access(first)
+    assert cache.get_least_recently_accessed(10) == [('foo/second', 50)]
+    assert cache.record_access(first, 200) == 1
+
+
+def test_lock(cache):
+    token = cache.lock('job', 10)
+    assert token
+    assert not cache.lock('job', 10)
+    assert cache.unlock('job', token)
+    assert cache.lock('job', 10)
+
+
+def test_unlock_checks_owner(cache):
+    token = cache.lock('job', 10)
+    # expired, and taken by someone else
+    cache.unlock('job', token)
+    other_token = cache.lock('job', 10)
+    assert not cache.unlock('job', token)
+    assert not cache.lock('job', 10)
+    assert cache.unlock('job', other_token)
@@ -3,7 +3,8 @@ import datetime
 import psycopg2
 import pytest
 
-from blockserver.backend.database import AbstractUserDatabase, PostgresUserDatabase
+from blockserver.backend.database import AbstractUserDatabase, PostgresUserDatabase, ReplicaPool
+from blockserver.backend.transfer import CAS_PREFIX
 import uuid
 UID = 1
 
@@ -122,3 +123,151 @@ def test_traffic_integrity(pg_db, prefix, mocker):
 
 def test_traffic_default(pg_db):
     assert pg_db.get_traffic_by_prefix("non existing prefix") == 0
+
+
+def test_reads_from_replica(pg_db, pg_replica_connection, user_id, prefix):
+    db = PostgresUserDatabase(pg_db.connection, pg_replica_connection)
+    assert db.has_prefix(user_id, prefix)
+    assert db.get_prefixes(user_id) == [prefix]
+    assert db.get_prefix_owner(prefix) == user_id
+    # the primary is not needed for reads
+    db.connection = None
+    assert db.get_traffic_by_prefix(prefix) == 0
+
+
+def test_reads_after_write_use_primary(pg_db, pg_replica_connection, user_id):
+    db = PostgresUserDatabase(pg_db.connection, pg_replica_connection)
+    prefix = db.create_prefix(user_id)
+    pg_replica_connection.close()
+    assert db.has_prefix(user_id, prefix)
+    db.update_size(prefix, 100)
+    assert db.get_size(user_id) == 100
+
+
+def test_new_prefix_missing_on_replica(pg_db, pg_replica_connection, user_id):
+    db = PostgresUserDatabase(pg_db.connection, pg_replica_connection)
+    # the replica lags behind: its snapshot is older than the prefix
+    pg_replica_connection.set_session(isolation_level='REPEATABLE READ')
+    pg_replica_connection.cursor().execute('SELECT 1 FROM prefixes')
+    prefix = pg_db.create_prefix(user_id)
+    assert db.has_prefix(user_id, prefix)
+    assert not db.has_prefix(user_id, 'other-prefix')
+
+
+def test_replica_pool_checks_lag(pg_connection):
+    import environs
+    pool = ReplicaPool([environs.Env()('DATABASE_URL')], max_lag=1)
+    connection = pool.getconn()
+    assert connection is not None
+    pool.putconn(connection)
+    pool.max_lag = -1
+    pool.check_interval = 0
+    assert pool.getconn() is None
+
+
+def test_correct_size(pg_db, user_id, prefix):
+    pg_db.update_size(prefix, 100)
+    size, version = pg_db.get_size_snapshot(user_id)
+    assert size == 100
+    # changed while recounting
+    pg_db.update_size(prefix, 10)
+    assert not pg_db.correct_size(user_id, version, 50)
+    assert pg_db.get_size(user_id) == 110
+    _, version = pg_db.get_size_snapshot(user_id)
+    assert pg_db.correct_size(user_id, version, 50)
+    assert pg_db.get_size(user_id) == 50
+
+
+def test_object_catalog(pg_db, user_id, prefix):
+    pg_db.store_object(prefix, 'foo', 10, 'etag-1', 10)
+    pg_db.store_object(prefix, 'foo', 12, 'etag-2', 2)
+    entry = pg_db.get_object(prefix, 'foo')
+    assert (entry.path, entry.size, entry.etag) == ('foo', 12, 'etag-2')
+    assert pg_db.get_size(user_id) == 12
+    pg_db.delete_object(prefix, 'foo', -12)
+    assert pg_db.get_object(prefix, 'foo') is None
+    assert pg_db.get_size(user_id) == 0
+
+
+def test_store_objects(pg_db, user_id, prefix):
+    pg_db.store_object(prefix, 'foo', 10, 'etag-1', 10)
+    pg_db.store_objects(prefix, [('foo', 12, 'etag-2', 'checksum'), ('bar', 3, 'etag-3', None)], 5)
+    objects = pg_db.get_objects(prefix, ['foo', 'bar'])
+    assert (objects['foo'].size, objects['foo'].etag, objects['foo'].checksum) == (12, 'etag-2', 'checksum')
+    assert objects['bar'].size == 3
+    assert pg_db.get_size(user_id) == 15
+
+
+def test_object_catalog_listing(pg_db, prefix):
+    paths = ['block/{}'.format(i) for i in range(5)] + ['meta']
+    for path in paths:
+        pg_db.store_object(prefix, path, 1, 'etag', 1)
+    first = pg_db.list_objects(prefix, limit=4)
+    assert [entry.path for entry in first] == paths[:4]
+    rest = pg_db.list_objects(prefix, after=first[-1].path, limit=4)
+    assert [entry.path for entry in rest] == paths[4:]
+    assert pg_db.list_objects('other-prefix') == []
+
+
+def test_catalog_is_transactional(pg_db, user_id, prefix):
+    with pytest.raises(psycopg2.IntegrityError):
+        pg_db.store_object(prefix, 'foo', 10, None, 10)
+    assert pg_db.get_object(prefix, 'foo') is None
+    assert pg_db.get_size(user_id) == 0
+
+
+def test_blob_references(pg_db, prefix):
+    assert not pg_db.link_blob('digest')
+    assert pg_db.add_blob('digest', 10)
+    assert pg_db.link_blob('digest')
+    pg_db.store_object(prefix, 'block/foo', 10, '"digest"', 10, 'digest')
+    pg_db.store_object(prefix, 'meta', 3, 'etag', 3)
+    assert pg_db.get_object(prefix, 'block/foo').digest == 'digest'
+    assert pg_db.get_deduplicated_size(prefix) == 10
+    assert not pg_db.unlink_blob('digest')
+    assert pg_db.unlink_blob('digest')
+    assert not pg_db.link_blob('digest')
+    assert pg_db.is_delete_pending(CAS_PREFIX, 'digest')
+    # stored again
+    assert pg_db.add_blob('digest', 10)
+    assert not pg_db.is_delete_pending(CAS_PREFIX, 'digest')
+
+
+def test_add_blob_being_removed(pg_db, pg_replica_connection):
+    assert pg_db.add_blob('digest', 10)
+    assert pg_db.unlink_blob('digest')
+    remover = PostgresUserDatabase(pg_replica_connection)
+    with remover.transaction():
+        assert remover.take_pending_deletes(10) == [(CAS_PREFIX, 'digest')]
+        assert pg_db.add_blob('digest', 10) is None
+        remover.remove_pending_deletes([(CAS_PREFIX, 'digest')])
+    assert not pg_db.link_blob('digest')
+
+
+def test_pending_deletes(pg_db, pg_replica_connection, prefix):
+    pg_db.defer_delete(prefix, 'foo')
+    pg_db.defer_delete(prefix, 'bar')
+    pg_db.defer_delete(prefix, 'foo')
+    assert pg_db.is_delete_pending(prefix, 'foo')
+    assert pg_db.cancel_delete(prefix, 'bar')
+    assert not pg_db.cancel_delete(prefix, 'bar')
+
+    remover = PostgresUserDatabase(pg_replica_connection)
+    with remover.transaction():
+        assert remover.take_pending_deletes(10) == [(prefix, 'foo')]
+        # being removed
+        assert pg_db.cancel_delete(prefix, 'foo') is None
+        assert pg_db.take_pending_deletes(10) == []
+        remover.remove_pending_deletes([(prefix, 'foo')])
+    assert not pg_db.is_delete_pending(prefix, 'foo')
+
+
+def test_cancel_deletes(pg_db, pg_replica_connection, prefix):
+    pg_db.defer_delete(prefix, 'foo')
+    pg_db.defer_delete(prefix, 'bar')
+    remover = PostgresUserDatabase(pg_replica_connection)
+    with remover.transaction():
+        assert remover.take_pending_deletes(1) == [(prefix, 'foo')]
+        assert pg_db.cancel_deletes(prefix, ['foo', 'bar', 'baz']) == ({'bar'}, {'foo'})
+        remover.remove_pending_deletes([(prefix, 'foo')])
+    assert pg_db.cancel_deletes(prefix, ['foo', 'bar']) == (set(), set())
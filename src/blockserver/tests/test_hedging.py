@@ -0,0 +1,106 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from blockserver.backend.hedging import Hedger
+from blockserver.backend.resilience import ConcurrencyLimiter
+
+
+@pytest.fixture
+def hedger():
+    with ThreadPoolExecutor(4) as executor:
+        hedger = Hedger(executor, 'get', 90, budget=0.5)
+        for _ in range(Hedger.MIN_SAMPLES):
+            hedger.call(lambda: None)
+        yield hedger
+
+
+def test_no_hedging_without_observations():
+    hedger = Hedger(None, 'get', 90, budget=1)
+    assert hedger.delay() is None
+    assert hedger.call(lambda: 'response') == 'response'
+
+
+def test_delay_is_percentile(hedger):
+    hedger._latencies.clear()
+    hedger._latencies.extend(range(1, 101))
+    assert hedger.delay() == 90
+
+
+def test_slow_request_is_hedged(hedger):
+    released = threading.Event()
+    calls = []
+    discarded = []
+
+    def request():
+        calls.append(None)
+        if len(calls) == 1:
+            released.wait(5)
+            return 'slow'
+        return 'fast'
+
+    hedger._latencies.clear()
+    hedger._latencies.extend([0.01] * Hedger.MIN_SAMPLES)
+    assert hedger.call(request, discard=discarded.append) == 'fast'
+    released.set()
+    hedger.executor.shutdown(wait=True)
+    assert len(calls) == 2
+    assert discarded == ['slow']
+
+
+def test_budget_caps_hedges(hedger):
+    hedger._tokens = 0
+    hedger._latencies.clear()
+    hedger._latencies.extend([0.001] * Hedger.MIN_SAMPLES)
+    calls = []
+
+    def request():
+        calls.append(None)
+        threading.Event().wait(0.05)
+
+    # every call earns half a hedge
+    hedger.call(request)
+    assert len(calls) == 1
+    hedger.call(request)
+    hedger.executor.shutdown(wait=True)
+    assert len(calls) == 3
+
+
+def test_hedge_takes_a_request_slot(hedger):
+    hedger.limiter = ConcurrencyLimiter(2)
+    # the slot of the first request, held by the caller
+    hedger.limiter.acquire(0)
+    hedger._latencies.clear()
+    hedger._latencies.extend([0.01] * Hedger.MIN_SAMPLES)
+    released = threading.Event()
+    in_flight = []
+
+    def request():
+        in_flight.append(hedger.limiter.in_flight)
+        if len(in_flight) == 1:
+            released.wait(5)
+        return len(in_flight)
+
+    assert hedger.call(request) == 2
+    assert in_flight == [1, 2]
+    # the slow request is still in flight
+    assert hedger.limiter.in_flight == 2
+    released.set()
+    hedger.executor.shutdown(wait=True)
+    assert hedger.limiter.in_flight == 1
+
+
+def test_no_hedge_without_free_slot(hedger):
+    hedger.limiter = ConcurrencyLimiter(1)
+    hedger.limiter.acquire(0)
+    hedger._latencies.clear()
+    hedger._latencies.extend([0.001] * Hedger.MIN_SAMPLES)
+    calls = []
+
+    def request():
+        calls.append(None)
+        threading.Event().wait(0.05)
+
+    hedger.call(request)
+    assert len(calls) == 1
@@ -0,0 +1,53 @@
+import os
+
+from blockserver import maintenance
+from blockserver.backend.transfer import LocalTransfer, StorageObject
+
+
+def store(transfer, prefix, path, testfile):
+    with open(testfile, 'wb') as file:
+        file.write(b'Dummy\n')
+    transfer.store(StorageObject(prefix, path, local_file=testfile))
+
+
+def test_reconcile_corrects_size(pg_db, transfer, testfile, user_id, prefix, tmpdir):
+    size = os.path.getsize(testfile)
+    store(transfer, prefix, 'foo', testfile)
+    store(transfer, prefix, 'block/bar', testfile)
+    second_prefix = pg_db.create_prefix(user_id)
+    store(transfer, second_prefix, 'foo', testfile)
+    pg_db.update_size(prefix, 12345)
+    state = maintenance.ProgressState(str(tmpdir.join('state')))
+
+    corrected = maintenance.reconcile(pg_db, transfer, 4, maintenance.RateLimiter(0), state)
+
+    assert corrected == 1
+    assert pg_db.get_size(user_id) == 3 * size
+    assert state.load() is None
+
+
+def test_reconcile_resumes(pg_db, transfer, testfile, prefix, tmpdir):
+    other_user = 1
+    other_prefix = pg_db.create_prefix(other_user)
+    pg_db.update_size(prefix, 100)
+    pg_db.update_size(other_prefix, 100)
+    state = maintenance.ProgressState(str(tmpdir.join('state')))
+    state.save(0)
+
+    maintenance.reconcile(pg_db, transfer, 4, maintenance.RateLimiter(0), state)
+
+    assert pg_db.get_size(0) == 100
+    assert pg_db.get_size(other_user) == 0
+
+
+def test_migrate_layout(cache, testfile, tmpdir):
+    flat = LocalTransfer(str(tmpdir), cache, fanout=0)
+    store(flat, 'prefix-a', 'foo', testfile)
+    store(flat, 'prefix-b', 'block/bar', testfile)
+    sharded = LocalTransfer(str(tmpdir), cache, fanout=1, flat_fallback=True)
+
+    assert maintenance.migrate_layout(sharded, 2) == 2
+    assert maintenance.migrate_layout(sharded, 2) == 0
+    sharded.flat_fallback = False
+    cache.flush()
+    assert sharded.meta(StorageObject('prefix-b', 'block/bar')).size == len(b'Dummy\n')
@@ -0,0 +1,62 @@
+import pytest
+
+from blockserver.multipart import MultipartError, MultipartParser, boundary, parse_options
+
+BODY = (b'preamble\r\n'
+        b'--boundary\r\n'
+        b'Content-Disposition: form-data; name="foo"\r\n'
+        b'\r\n'
+        b'Dummy\r\n'
+        b'--boundary  \r\n'
+        b'Content-Disposition: form-data; name="block/bar"\r\n'
+        b'Content-Type: application/octet-stream\r\n'
+        b'\r\n'
+        b'\r\n--boundar\r\n'
+        b'--boundary--\r\n'
+        b'epilogue')
+
+
+class Part(list):
+    def __init__(self, headers):
+        super().__init__()
+        self.headers = headers
+
+    def write(self, data):
+        self.append(data)
+
+
+def parse(body, chunk_size):
+    parts = []
+    parser = MultipartParser(b'boundary', Part, parts.append)
+    for start in range(0, len(body), chunk_size):
+        parser.feed(body[start:start + chunk_size])
+    parser.finish()
+    return parts
+
+
+def test_parse_options():
+    assert parse_options('form-data; name="block/foo"; x=1') == ('form-data', {'name': 'block/foo', 'x': '1'})
+    assert boundary('multipart/form-data; boundary="abc"') == b'abc'
+    with pytest.raises(MultipartError):
+        boundary('application/octet-stream')
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 11, len(BODY)])
+def test_parse(chunk_size):
+    parts = parse(BODY, chunk_size)
+    assert [part.headers['Content-Disposition'] for part in parts] == [
+        'form-data; name="foo"', 'form-data; name="block/bar"']
+    assert [b''.join(part) for part in parts] == [b'Dummy', b'\r\n--boundar']
+
+
+def test_incomplete_body():
+    with pytest.raises(MultipartError):
+        parse(BODY[:60], 7)
+    with pytest.raises(MultipartError):
+        parse(BODY.replace(b'--boundary  \r\n', b'--boundaryX\r\n'), 7)
+
+
+@pytest.mark.parametrize('headers', [b'no colon here', b'Content-Disposition: \xff'])
+def test_malformed_part_headers(headers):
+    with pytest.raises(MultipartError):
+        parse(b'--boundary\r\n' + headers + b'\r\n\r\nDummy\r\n--boundary--\r\n', 7)
@@ -0,0 +1,61 @@
+import io
+import os
+
+from blockserver.backend.objectcache import DiskObjectCache
+
+
+def fill(cache, key, etag, data, read_all=True):
+    reader = cache.fill(key, etag, len(data), io.BytesIO(data))
+    if read_all:
+        while reader.read(3):
+            pass
+    else:
+        reader.read(1)
+    reader.close()
+
+
+def test_fill_and_open(tmpdir):
+    cache = DiskObjectCache(str(tmpdir), 1000)
+    assert cache.open('foo/bar', 'etag') is None
+    fill(cache, 'foo/bar', 'etag', b'Dummy')
+    with cache.open('foo/bar', 'etag') as file:
+        assert file.read() == b'Dummy'
+    assert cache.open('foo/bar', 'other-etag') is None
+
+
+def test_incomplete_fill_is_discarded(tmpdir):
+    cache = DiskObjectCache(str(tmpdir), 1000)
+    fill(cache, 'foo/bar', 'etag', b'Dummy', read_all=False)
+    assert cache.open('foo/bar', 'etag') is None
+    assert list(cache._entries()) == []
+
+
+def test_abandoned_fill_is_evicted(tmpdir):
+    cache = DiskObjectCache(str(tmpdir), 100)
+    reader = cache.fill('foo/abandoned', 'etag', 10, io.BytesIO(b'+' * 10))
+    reader.read()
+    (_, _, path), = cache._entries()
+    os.utime(path, ns=(0, 0))
+    # the abandoned fill isn't accounted, only the next eviction sees it
+    for i in range(11):
+        fill(cache, 'foo/{}'.format(i), 'etag', b'+' * 10)
+    assert not os.path.exists(path)
+
+
+def test_large_objects_are_not_cached(tmpdir):
+    cache = DiskObjectCache(str(tmpdir), 1000)
+    source = io.BytesIO(b'+' * 101)
+    assert cache.fill('foo/bar', 'etag', 101, source) is source
+
+
+def test_evicts_least_recently_used(tmpdir):
+    cache = DiskObjectCache(str(tmpdir), 100)
+    for i in range(10):
+        fill(cache, 'foo/{}'.format(i), 'etag', b'+' * 10)
+        # make the access order visible to the mtime based LRU
+        os.utime(cache._path('foo/{}'.format(i), 'etag'), ns=(i * 10**9, i * 10**9))
+    fill(cache, 'foo/new', 'etag', b'+' * 10)
+    assert cache.open('foo/0', 'etag') is None
+    assert cache.open('foo/9', 'etag') is not None
+    assert cache.open('foo/new', 'etag') is not None
+    assert sum(size for _, size, _ in cache._entries()) <= 90
@@ -0,0 +1,76 @@
+import os
+
+from blockserver.backend.packing import PackedLocalTransfer
+from blockserver.backend.transfer import StorageObject
+
+
+def store(transfer, path, content, testfile):
+    with open(testfile, 'wb') as file:
+        file.write(content)
+    return transfer.store(StorageObject('foo', path, local_file=testfile))
+
+
+def read(transfer, path):
+    downloaded = transfer.retrieve(StorageObject('foo', path))
+    try:
+        return downloaded.fd.read()
+    finally:
+        downloaded.fd.close()
+
+
+def segment_files(transfer):
+    return [name for name in os.listdir(transfer.segments.directory) if name.endswith('.seg')]
+
+
+def test_small_objects_are_packed(cache, testfile, tmpdir):
+    transfer = PackedLocalTransfer(str(tmpdir), cache, threshold=10)
+    uploaded, size_diff = store(transfer, 'block/a', b'small', testfile)
+    assert size_diff == 5
+    store(transfer, 'block/b', b'larger than ten', testfile)
+    assert not (tmpdir / 'foo' / 'block' / 'a').exists()
+    assert (tmpdir / 'foo' / 'block' / 'b').exists()
+    assert len(segment_files(transfer)) == 1
+
+    cache.flush()
+    assert read(transfer, 'block/a') == b'small'
+    assert read(transfer, 'block/b') == b'larger than ten'
+    assert transfer.meta(StorageObject('foo', 'block/a')) == StorageObject('foo', 'block/a', etag=uploaded.etag, size=5)
+    assert transfer.retrieve(uploaded).fd is None
+    assert sorted((o.file_path, o.size) for o in transfer.list_objects('foo')) == [('block/a', 5), ('block/b', 15)]
+
+
+def test_overwrite_and_delete(cache, testfile, tmpdir):
+    transfer = PackedLocalTransfer(str(tmpdir), cache, threshold=10)
+    store(transfer, 'a', b'first', testfile)
+    _, size_diff = store(transfer, 'a', b'second', testfile)
+    assert size_diff == 1
+    _, size_diff = store(transfer, 'a', b'now it is large', testfile)
+    assert size_diff == 9
+    assert transfer.segments.get('foo/a') is None
+    _, size_diff = store(transfer, 'a', b'small', testfile)
+    assert size_diff == -10
+    assert not (tmpdir / 'foo' / 'a').exists()
+    assert transfer.delete(StorageObject('foo', 'a')) == 5
+    assert transfer.meta(StorageObject('foo', 'a')) is None
+    assert transfer.delete(StorageObject('foo', 'a')) == 0
+
+
+def test_compaction(cache, testfile, tmpdir):
+    transfer = PackedLocalTransfer(str(tmpdir), cache, threshold=10, segment_size=20)
+    for index in range(6):
+        store(transfer, str(index), b'data%d' % index, testfile)
+    for index in range(4):
+        transfer.delete(StorageObject('foo', str(index)))
+    etag = transfer.meta(StorageObject('foo', '5')).etag
+    # every record fills a segment
+    assert len(segment_files(transfer)) == 6
+
+    # a separate store, as the compact job uses
+    compactor = PackedLocalTransfer(str(tmpdir), cache, threshold=10, segment_size=20)
+    assert compactor.segments.compact(0.5) > 0
+    # the active segment of transfer (with 5) is kept, 4 was moved to the active segment of compactor
+    assert len(segment_files(transfer)) == 2
+    cache.flush()
+    assert read(transfer, '4') == b'data4'
+    assert read(transfer, '5') == b'data5'
+    assert transfer.meta(StorageObject('foo', '5')).etag == etag
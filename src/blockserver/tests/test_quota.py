@@ -22,3 +22,10 @@ def test_quota_reached_meta_upload_granted(quota_policy):
     assert quota_policy.upload(True, 10, False, True)
     assert quota_policy.upload(True, 0, False, True)
     assert not quota_policy.upload(True, 150 * 1024, False, True)
+
+
+def test_headroom(quota_policy):
+    assert quota_policy.has_headroom(0, 10, 100)
+    assert quota_policy.has_headroom(80, 10, 100)
+    assert not quota_policy.has_headroom(81, 10, 100)
+    assert not quota_policy.has_headroom(0, 0, 0)
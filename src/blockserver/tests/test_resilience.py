@@ -0,0 +1,71 @@
+import time
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from blockserver.backend.resilience import ConcurrencyLimiter, DeadlineExceeded, Retrier, classify
+
+
+def client_error(status, code):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'GetObject')
+
+
+def test_classify():
+    assert classify(client_error(503, 'SlowDown')) == (True, True)
+    assert classify(client_error(500, 'InternalError')) == (True, False)
+    assert classify(client_error(404, 'NoSuchKey')) == (False, False)
+    assert classify(EndpointConnectionError(endpoint_url='http://s3')) == (True, False)
+    assert classify(ValueError()) == (False, False)
+
+
+def test_limiter_aimd():
+    limiter = ConcurrencyLimiter(8)
+    limiter.acquire(time.monotonic() + 1)
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    # the following throttled requests were in flight at the same time
+    limiter.acquire(time.monotonic() + 1)
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    limiter.acquire(time.monotonic() + 1)
+    limiter.release()
+    assert limiter.limit == 4.25
+
+
+def test_limiter_deadline():
+    limiter = ConcurrencyLimiter(1)
+    limiter.acquire(time.monotonic() + 1)
+    with pytest.raises(DeadlineExceeded):
+        limiter.acquire(time.monotonic() + 0.01)
+
+
+def test_retries_throttled_requests():
+    retrier = Retrier(ConcurrencyLimiter(4), attempts=3, deadline=10, base=0.001, cap=0.01)
+    responses = [client_error(503, 'SlowDown'), client_error(500, 'InternalError'), 'response']
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert retrier.call('get', request) == 'response'
+    assert retrier.limiter.in_flight == 0
+    assert retrier.limiter.limit < 4
+
+
+def test_gives_up():
+    retrier = Retrier(ConcurrencyLimiter(4), attempts=2, deadline=10, base=0.001, cap=0.01)
+    calls = []
+
+    def request(error):
+        calls.append(None)
+        raise error
+
+    with pytest.raises(ClientError):
+        retrier.call('get', lambda: request(client_error(404, 'NoSuchKey')))
+    assert len(calls) == 1
+    with pytest.raises(ClientError):
+        retrier.call('get', lambda: request(client_error(503, 'SlowDown')))
+    assert len(calls) == 3
+    assert retrier.limiter.in_flight == 0
@@ -1,6 +1,9 @@
+import io
 import json
+import tarfile
 from functools import partial
 
+import psycopg2
 import pytest
 from prometheus_client import REGISTRY
 from tornado.httpclient import HTTPError, HTTPRequest
@@ -11,6 +14,10 @@ from unittest.mock import call
 from tornado.websocket import websocket_connect
 
 from blockserver.backend.auth import DummyAuth
+from blockserver.backend.database import PostgresUserDatabase
+from blockserver.backend.deletion import DeleteQueue
+from blockserver.backend.transfer import CAS_PREFIX, LocalTransfer, StorageObject
+from blockserver.server import FileHandler, TransferConnector, get_transfer_cls
 
 
 def stat_by_name(stat_name):
@@ -202,6 +209,29 @@ def test_get_prefixes(app, http_client, prefix_path, user_id, headers, pg_db):
     assert parsed_response == {'prefixes': prefixes}
 
 
+@pytest.mark.gen_test
+def test_list_objects(backend, http_client, base_url, prefix, headers):
+    url = base_url + '/api/v0/files/{}/'.format(prefix)
+    etags = {}
+    for name in ('a', 'b', 'block/c'):
+        response = yield http_client.fetch(url + name, method='POST', body=b'Dummy', headers=headers)
+        etags[name] = response.headers['ETag']
+    response = yield http_client.fetch(url + '?limit=2', headers=headers)
+    listing = json.loads(response.body.decode('utf-8'))
+    assert [(o['path'], o['etag'], o['size']) for o in listing['objects']] == [('a', etags['a'], 5),
+                                                                              ('b', etags['b'], 5)]
+    response = yield http_client.fetch(url + '?limit=2&after=' + listing['next'], headers=headers)
+    listing = json.loads(response.body.decode('utf-8'))
+    assert [o['path'] for o in listing['objects']] == ['block/c']
+    assert listing['next'] is None
+
+
+@pytest.mark.gen_test
+def test_list_objects_requires_auth(backend, http_client, base_url, prefix):
+    response = yield http_client.fetch(base_url + '/api/v0/files/{}/'.format(prefix), raise_error=False)
+    assert response.code == 403
+
+
 @pytest.mark.gen_test
 def test_log_and_monitoring(backend, mocker, http_client, path, auth_path, headers,
                             auth_server, file_path, prefix):
@@ -323,6 +353,43 @@ def test_quota_delete_and_download(backend, http_client, prefix, path, headers,
         assert response.code == 204
 
 
+@pytest.mark.gen_test
+def test_quota_check_uses_cached_usage(backend, http_client, path, headers, mocker):
+    get_size = mocker.spy(PostgresUserDatabase, 'get_size')
+    response = yield http_client.fetch(path, method='POST', body=b'Dummy', headers=headers)
+    assert response.code == 204
+    assert get_size.call_count == 1
+    response = yield http_client.fetch(path + 'x', method='POST', body=b'Dummy', headers=headers)
+    assert response.code == 204
+    assert get_size.call_count == 1
+
+
+@pytest.mark.gen_test
+def test_quota_reservation_released(backend, http_client, block_path, headers, cache, user_id, monkeypatch):
+    monkeypatch.setattr(DummyAuth, 'QUOTA', 10)
+    response = yield http_client.fetch(block_path, method='POST', body=b'Dummy', headers=headers)
+    assert response.code == 204
+    assert cache.get_usage(user_id) == 5
+    response = yield http_client.fetch(block_path + '2', method='POST', body=b'Dummy!', headers=headers,
+                                       raise_error=False)
+    assert response.code == 402
+    # nothing is left reserved by the denied upload
+    assert cache.reserve_usage(user_id, 5, 5, 10)
+
+
+@pytest.mark.gen_test
+def test_traffic_check_uses_cache(backend, http_client, path, headers, mocker, prefix):
+    response = yield http_client.fetch(path, method='POST', body=b'Dummy', headers=headers)
+    assert response.code == 204
+    yield http_client.fetch(path, method='GET')
+    get_owner = mocker.spy(PostgresUserDatabase, 'get_prefix_owner')
+    get_traffic = mocker.spy(PostgresUserDatabase, 'get_traffic')
+    response = yield http_client.fetch(path, method='GET')
+    assert response.body == b'Dummy'
+    assert not get_owner.called
+    assert not get_traffic.called
+
+
 @pytest.mark.gen_test
 def test_denies_too_big_body(app_options, backend, http_client, path, headers, temp_check):
     app_options.max_body_size = 1
@@ -412,6 +479,287 @@ def test_ws_post(backend, http_client, path, file_path, websocket_file_connector
     assert msg['etag'] == response.headers['ETag']
 
 
+@pytest.mark.gen_test
+def test_unchanged_upload_skipped(backend, http_client, path, websocket_file_connector, headers, mocker):
+    conn = yield websocket_file_connector
+    response = yield http_client.fetch(path, method='POST', body=b'Dummy', headers=headers)
+    etag = response.headers['ETag']
+    store_file = mocker.spy(TransferConnector, 'store_file')
+
+    response = yield http_client.fetch(path, method='POST', body=b'Dummy', headers=headers)
+    assert response.code == 204
+    assert response.headers['ETag'] == etag
+    assert not store_file.called
+    response = yield http_client.fetch(path, method='POST', body=b'OtherDummy', headers=headers)
+    assert store_file.called
+
+    msg = json.loads((yield conn.read_message()))
+    assert msg['etag'] == etag
+    # nothing was published for the unchanged upload
+    msg = json.loads((yield conn.read_message()))
+    assert msg['etag'] == response.headers['ETag']
+
+
+@pytest.mark.gen_test
+def test_copy_and_move(backend, http_client, base_url, prefix, headers, pg_db, user_id):
+    def url(name):
+        return base_url + '/api/v0/files/{}/{}'.format(prefix, name)
+    body = b'Dummy'
+    yield http_client.fetch(url('source'), method='POST', body=body, headers=headers)
+
+    copy_headers = {'X-Copy-Source': prefix + '/source', **headers}
+    response = yield http_client.fetch(url('copy'), method='POST', body=b'', headers=copy_headers)
+    assert response.code == 204
+    response = yield http_client.fetch(url('copy'), method='GET', headers=headers)
+    assert response.body == body
+    assert pg_db.get_size(user_id) == 2 * len(body)
+
+    move_headers = {'X-Move-Source': prefix + '/copy', **headers}
+    response = yield http_client.fetch(url('moved'), method='POST', body=b'', headers=move_headers)
+    assert response.code == 204
+    response = yield http_client.fetch(url('moved'), method='GET', headers=headers)
+    assert response.body == body
+    response = yield http_client.fetch(url('copy'), method='GET', headers=headers, raise_error=False)
+    assert response.code == 404
+    assert pg_db.get_size(user_id) == 2 * len(body)
+
+    response = yield http_client.fetch(url('other'), method='POST', body=b'', headers=move_headers,
+                                       raise_error=False)
+    assert response.code == 404
+    invalid_headers = {'X-Copy-Source': '.cas/' + 'a' * 64, **headers}
+    response = yield http_client.fetch(url('other'), method='POST', body=b'', headers=invalid_headers,
+                                       raise_error=False)
+    assert response.code == 400
+
+
+@pytest.mark.gen_test
+def test_deferred_delete(app_options, backend, http_client, path, file_path, headers, pg_db, user_id, cache):
+    app_options.deferred_deletes = True
+    app_options.deferred_delete_interval = 0
+    _, prefix, name = file_path.split('/', 2)
+    yield http_client.fetch(path, method='POST', body=b'Dummy', headers=headers)
+    response = yield http_client.fetch(path, method='DELETE', headers=headers)
+    assert response.code == 204
+    assert pg_db.get_size(user_id) == 0
+    response = yield http_client.fetch(path, method='GET', headers=headers, raise_error=False)
+    assert response.code == 404
+    # without the tombstone
+    cache.flush()
+    response = yield http_client.fetch(path, method='GET', headers=headers, raise_error=False)
+    assert response.code == 404
+    response = yield http_client.fetch(path, method='HEAD', headers=headers, raise_error=False)
+    assert response.code == 404
+    response = yield http_client.fetch(path, method='DELETE', headers=headers)
+    assert pg_db.get_size(user_id) == 0
+
+    transfer = get_transfer_cls()(cache=cache)
+    assert transfer.meta(StorageObject(prefix, name)) is not None
+    assert DeleteQueue(pg_db, transfer, cache).purge() == 1
+    assert transfer.meta(StorageObject(prefix, name)) is None
+
+    # stored again before the removal
+    yield http_client.fetch(path, method='POST', body=b'Dummy', headers=headers)
+    yield http_client.fetch(path, method='DELETE', headers=headers)
+    response = yield http_client.fetch(path, method='POST', body=b'Other', headers=headers)
+    assert response.code == 204
+    assert pg_db.get_size(user_id) == len(b'Other')
+    assert DeleteQueue(pg_db, transfer, cache).purge() == 0
+    response = yield http_client.fetch(path, method='GET', headers=headers)
+    assert response.body == b'Other'
+
+
+def test_delete_queue_reconnects(pg_db, pg_connection, prefix, cache, tmpdir):
+    def connect():
+        return PostgresUserDatabase(psycopg2.connect(pg_connection.dsn))
+    db = connect()
+    db.connection.close()
+    queue = DeleteQueue(db, LocalTransfer(str(tmpdir), cache), cache, connect)
+    pg_db.defer_delete(prefix, 'foo')
+    queue._purge_logged()
+    assert pg_db.is_delete_pending(prefix, 'foo')
+    queue._purge_logged()
+    assert not pg_db.is_delete_pending(prefix, 'foo')
+
+
+@pytest.mark.gen_test
+def test_store_while_removing(app_options, backend, http_client, path, file_path, headers, pg_db,
+                              pg_replica_connection, monkeypatch):
+    app_options.deferred_deletes = True
+    app_options.deferred_delete_interval = 0
+    monkeypatch.setattr(FileHandler, 'REMOVAL_TIMEOUT', 0.2)
+    _, prefix, name = file_path.split('/', 2)
+    yield http_client.fetch(path, method='POST', body=b'Dummy', headers=headers)
+    yield http_client.fetch(path, method='DELETE', headers=headers)
+    remover = PostgresUserDatabase(pg_replica_connection)
+    with remover.transaction():
+        assert remover.take_pending_deletes(10) == [(prefix, name)]
+        response = yield http_client.fetch(path, method='POST', body=b'Other', headers=headers, raise_error=False)
+        assert response.code == 503
+        remover.remove_pending_deletes([(prefix, name)])
+    response = yield http_client.fetch(path, method='POST', body=b'Other', headers=headers)
+    assert response.code == 204
+
+
+@pytest.mark.gen_test
+def test_bulk_delete(backend, http_client, base_url, prefix, headers, pg_db, user_id):
+    def url(name):
+        return base_url + '/api/v0/files/{}/{}'.format(prefix, name)
+    names = ['foo', 'bar', 'block/baz']
+    for name in names:
+        yield http_client.fetch(url(name), method='POST', body=b'Dummy', headers=headers)
+    delete_url = base_url + '/api/v0/delete/{}/'.format(prefix)
+
+    body = json.dumps({'paths': ['foo', 'block/baz', 'missing']})
+    response = yield http_client.fetch(delete_url, method='POST', body=body, headers=headers)
+    assert json.loads(response.body.decode()) == {'deleted': 2, 'size': 10}
+    for name in ('foo', 'block/baz'):
+        response = yield http_client.fetch(url(name), method='GET', headers=headers, raise_error=False)
+        assert response.code == 404
+    assert pg_db.get_size(user_id) == 5
+
+    response = yield http_client.fetch(delete_url, method='DELETE', headers=headers)
+    assert json.loads(response.body.decode()) == {'deleted': 1, 'size': 5}
+    response = yield http_client.fetch(url('bar'), method='GET', headers=headers, raise_error=False)
+    assert response.code == 404
+    assert pg_db.get_size(user_id) == 0
+
+    response = yield http_client.fetch(delete_url, method='POST', body=json.dumps({'paths': ['../foo']}),
+                                       headers=headers, raise_error=False)
+    assert response.code == 400
+
+
+@pytest.mark.gen_test
+def test_bulk_delete_sweep(app_options, backend, http_client, base_url, prefix, headers, cache, tmpdir):
+    transfer = get_transfer_cls()(cache=cache)
+    # stored before the catalog
+    local_file = tmpdir.join('old')
+    local_file.write(b'Dummy')
+    transfer.store(StorageObject(prefix, 'old', None, str(local_file)))
+    delete_url = base_url + '/api/v0/delete/{}/'.format(prefix)
+
+    app_options.bulk_delete_sweep = False
+    response = yield http_client.fetch(delete_url, method='DELETE', headers=headers)
+    assert json.loads(response.body.decode())['deleted'] == 0
+    assert transfer.meta(StorageObject(prefix, 'old')) is not None
+
+    app_options.bulk_delete_sweep = True
+    response = yield http_client.fetch(delete_url, method='DELETE', headers=headers)
+    assert json.loads(response.body.decode())['deleted'] == 1
+    assert transfer.meta(StorageObject(prefix, 'old')) is None
+
+
+@pytest.mark.gen_test
+def test_sync_check(backend, http_client, base_url, prefix, headers):
+    def url(name):
+        return base_url + '/api/v0/files/{}/{}'.format(prefix, name)
+    etags = {}
+    for name in ('foo', 'bar'):
+        response = yield http_client.fetch(url(name), method='POST', body=b'Dummy', headers=headers)
+        etags[name] = response.headers['ETag']
+    response = yield http_client.fetch(url('bar'), method='POST', body=b'Changed', headers=headers)
+    new_etag = response.headers['ETag']
+
+    body = json.dumps({'objects': [{'path': 'foo', 'etag': etags['foo']},
+                                   {'path': 'bar', 'etag': etags['bar']},
+                                   {'path': 'missing', 'etag': 'gone'}]})
+    response = yield http_client.fetch(base_url + '/api/v0/sync/{}/'.format(prefix), method='POST', body=body)
+    assert json.loads(response.body.decode())['changed'] == [
+        {'path': 'bar', 'etag': new_etag, 'size': len(b'Changed')},
+        {'path': 'missing', 'etag': None, 'size': None},
+    ]
+
+
+@pytest.mark.gen_test
+def test_head(backend, http_client, path, headers):
+    response = yield http_client.fetch(path, method='HEAD', raise_error=False)
+    assert response.code == 404
+    response = yield http_client.fetch(path, method='POST', body=b'Dummy', headers=headers)
+    etag = response.headers['ETag']
+
+    response = yield http_client.fetch(path, method='HEAD')
+    assert response.code == 200
+    assert response.headers['ETag'] == etag
+    assert response.headers['Content-Length'] == str(len(b'Dummy'))
+    assert response.body == b''
+    response = yield http_client.fetch(path, method='HEAD', headers={'If-None-Match': etag}, raise_error=False)
+    assert response.code == 304
+
+
+def multipart_body(parts, boundary='boundary'):
+    body = b''
+    for name, data in parts:
+        body += ('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n'.format(boundary, name)).encode() + data
+        body += b'\r\n'
+    return body + '--{}--\r\n'.format(boundary).encode()
+
+
+@pytest.mark.gen_test
+def test_batch_upload(backend, http_client, base_url, prefix, headers, pg_db, user_id):
+    upload_url = base_url + '/api/v0/upload/{}/'.format(prefix)
+    headers['Content-Type'] = 'multipart/form-data; boundary=boundary'
+    parts = [('foo', b'Dummy'), ('block/bar', b'\r\n--boundar')]
+    response = yield http_client.fetch(upload_url, method='POST', body=multipart_body(parts), headers=headers)
+    assert response.code == 200
+    objects = json.loads(response.body.decode())['objects']
+    assert [(entry['path'], entry['size']) for entry in objects] == [('foo', 5), ('block/bar', 11)]
+    assert pg_db.get_size(user_id) == 16
+
+    del headers['Content-Type']
+    for name, data in parts:
+        response = yield http_client.fetch(base_url + '/api/v0/files/{}/{}'.format(prefix, name), headers=headers)
+        assert response.body == data
+
+    headers['Content-Type'] = 'multipart/form-data; boundary=boundary'
+    response = yield http_client.fetch(upload_url, method='POST', body=multipart_body([('../foo', b'x')]),
+                                       headers=headers, raise_error=False)
+    assert response.code == 400
+    response = yield http_client.fetch(upload_url, method='POST', body=multipart_body(parts)[:-10],
+                                       headers=headers, raise_error=False)
+    assert response.code == 400
+    response = yield http_client.fetch(upload_url, method='POST',
+                                       body=b'--boundary\r\nno colon\r\n\r\nx\r\n--boundary--\r\n',
+                                       headers=headers, raise_error=False)
+    assert response.code == 400
+
+
+@pytest.mark.gen_test
+def test_batch_upload_quota(backend, http_client, base_url, prefix, headers, pg_db, user_id, monkeypatch):
+    monkeypatch.setattr(DummyAuth, 'QUOTA', 0)
+    upload_url = base_url + '/api/v0/upload/{}/'.format(prefix)
+    headers['Content-Type'] = 'multipart/form-data; boundary=boundary'
+    response = yield http_client.fetch(upload_url, method='POST', body=multipart_body([('foo', b'Dummy')]),
+                                       headers=headers)
+    assert response.code == 200
+    response = yield http_client.fetch(upload_url, method='POST',
+                                       body=multipart_body([('foo', b'Dummy'), ('block/bar', b'Dummy')]),
+                                       headers=headers, raise_error=False)
+    assert response.code == 402
+
+
+@pytest.mark.gen_test
+def test_archive(backend, http_client, base_url, prefix, headers, pg_db, user_id):
+    etags = {}
+    for name, data in (('foo', b'Dummy'), ('block/bar', b'OtherDummy')):
+        response = yield http_client.fetch(base_url + '/api/v0/files/{}/{}'.format(prefix, name), method='POST',
+                                           body=data, headers=headers)
+        etags[name] = response.headers['ETag']
+    traffic = pg_db.get_traffic(user_id)
+
+    url = base_url + '/api/v0/archive/{}/?path=foo&path=block/bar&path=missing'.format(prefix)
+    response = yield http_client.fetch(url)
+    assert response.headers['Content-Type'] == 'application/x-tar'
+    archive = tarfile.open(fileobj=io.BytesIO(response.body))
+    members = archive.getmembers()
+    assert [member.name for member in members] == ['foo', 'block/bar']
+    assert [archive.extractfile(member).read() for member in members] == [b'Dummy', b'OtherDummy']
+    assert [member.pax_headers['QABEL.etag'] for member in members] == [etags['foo'], etags['block/bar']]
+    assert pg_db.get_traffic(user_id) == traffic + len(b'DummyOtherDummy')
+
+    response = yield http_client.fetch(base_url + '/api/v0/archive/{}/?path=../foo'.format(prefix),
+                                       raise_error=False)
+    assert response.code == 400
+
+
 @pytest.mark.gen_test
 def test_ws_delete(backend, http_client, path, file_path, websocket_file_connector, headers, prefix):
     # n.b. moving this line around wouldn't matter much -- it's largely undefined when subscribers start to get messages
@@ -481,3 +829,39 @@ def test_ws_prefix_wrong_authorization(backend, http_server, websocket_prefix_co
         assert False, 'Did not raise'
     except HTTPError as error:
         assert error.code == 403
+
+
+@pytest.mark.gen_test
+def test_deduplicated_blocks(app_options, backend, http_client, base_url, prefix, headers, pg_db, user_id):
+    app_options.dedup_blocks = True
+    other_prefix = pg_db.create_prefix(user_id)
+    paths = [base_url + '/api/v0/files/{}/block/foobar'.format(p) for p in (prefix, other_prefix)]
+    body = b'Shared block'
+    etags = []
+    for path in paths:
+        response = yield http_client.fetch(path, method='POST', body=body, headers=headers)
+        assert response.code == 204
+        etags.append(response.headers['ETag'])
+    assert etags[0] == etags[1]
+    digest = etags[0].strip('"')
+    assert pg_db.get_deduplicated_size(prefix) == len(body)
+    assert pg_db.get_size(user_id) == 2 * len(body)
+
+    response = yield http_client.fetch(paths[1], method='GET', headers=headers)
+    assert response.body == body
+    response = yield http_client.fetch(paths[1], method='GET', raise_error=False,
+                                       headers={'If-None-Match': etags[0], **headers})
+    assert response.code == 304
+
+    response = yield http_client.fetch(paths[0], method='DELETE', headers=headers)
+    assert response.code == 204
+    response = yield http_client.fetch(paths[0], method='GET', headers=headers, raise_error=False)
+    assert response.code == 404
+    response = yield http_client.fetch(paths[1], method='GET', headers=headers)
+    assert response.body == body
+    response = yield http_client.fetch(paths[1], method='DELETE', headers=headers)
+    assert response.code == 204
+    assert pg_db.get_size(user_id) == 0
+    # the last reference is gone, its content is queued for removal
+    assert not pg_db.link_blob(digest)
+    assert pg_db.is_delete_pending(CAS_PREFIX, digest)
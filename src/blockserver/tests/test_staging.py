@@ -0,0 +1,98 @@
+import os
+
+from blockserver.backend.staging import StagingTransfer, md5_etag
+from blockserver.backend.transfer import LocalTransfer, StorageObject
+
+
+def make_transfer(tmpdir, cache):
+    remote = LocalTransfer(str(tmpdir.join('remote')), cache)
+    return StagingTransfer(str(tmpdir.join('staging')), cache, remote=remote), remote
+
+
+def wait_for_replication(transfer):
+    transfer._executor.shutdown(wait=True)
+
+
+def test_store_is_served_from_staging(tmpdir, cache, testfile):
+    transfer, remote = make_transfer(tmpdir, cache)
+    transfer._enqueue = lambda *args: None  # no replication
+    size = os.path.getsize(testfile)
+    etag = md5_etag(testfile)
+
+    uploaded, size_diff = transfer.store(StorageObject('foo', 'bar', local_file=testfile))
+    assert size_diff == size
+    assert uploaded.etag == etag
+    # not in S3 yet (its meta would be answered from the shared cache)
+    assert not (remote.basepath / 'foo' / 'bar').exists()
+    assert os.listdir(str(transfer.pending)) == ['foo%2Fbar']
+
+    cache.flush()
+    downloaded = transfer.retrieve(StorageObject('foo', 'bar'))
+    assert downloaded.etag == etag
+    assert downloaded.size == size
+    downloaded.fd.close()
+    assert transfer.meta(StorageObject('foo', 'bar')).etag == etag
+
+
+def test_replication(tmpdir, cache, testfile):
+    transfer, remote = make_transfer(tmpdir, cache)
+    with open(testfile) as file:
+        content = file.read()
+    transfer.store(StorageObject('foo', 'bar/baz', local_file=testfile))
+    wait_for_replication(transfer)
+
+    assert not os.listdir(str(transfer.pending))
+    assert not transfer._staged_path(StorageObject('foo', 'bar/baz')).exists()
+    with open(str(remote.basepath / 'foo' / 'bar' / 'baz')) as file:
+        assert file.read() == content
+
+
+def test_delete_staged(tmpdir, cache, testfile):
+    transfer, remote = make_transfer(tmpdir, cache)
+    transfer._enqueue = lambda *args: None
+    size = os.path.getsize(testfile)
+    transfer.store(StorageObject('foo', 'bar', local_file=testfile))
+    assert transfer.delete(StorageObject('foo', 'bar')) == size
+    assert transfer.meta(StorageObject('foo', 'bar')) is None
+    assert not os.listdir(str(transfer.pending))
+
+
+def test_delete_staged_over_replicated(tmpdir, cache, testfile):
+    transfer, remote = make_transfer(tmpdir, cache)
+    transfer._enqueue = lambda *args: None
+    old_version = str(tmpdir.join('old'))
+    with open(old_version, 'wb') as file:
+        file.write(b'old')
+    remote.store(StorageObject('foo', 'bar', local_file=old_version))
+    size = os.path.getsize(testfile)
+    transfer.store(StorageObject('foo', 'bar', local_file=testfile))
+    # the size of the current version, not of the one in S3
+    assert transfer.delete(StorageObject('foo', 'bar')) == size
+    assert remote.meta(StorageObject('foo', 'bar')) is None
+
+
+def test_recovery(tmpdir, cache, testfile):
+    transfer, remote = make_transfer(tmpdir, cache)
+    transfer._enqueue = lambda *args: None
+    transfer.store(StorageObject('foo', 'bar', local_file=testfile))
+    transfer._executor.shutdown()
+
+    # "restart"
+    transfer, remote = make_transfer(tmpdir, cache)
+    wait_for_replication(transfer)
+    assert (remote.basepath / 'foo' / 'bar').exists()
+    assert not os.listdir(str(transfer.pending))
+
+
+def test_list_objects(tmpdir, cache, testfile):
+    transfer, remote = make_transfer(tmpdir, cache)
+    transfer._enqueue = lambda *args: None
+    with open(testfile, 'w') as file:
+        file.write('replicated')
+    remote.store(StorageObject('foo', 'a', local_file=testfile))
+    with open(testfile, 'w') as file:
+        file.write('staged')
+    transfer.store(StorageObject('foo', 'b', local_file=testfile))
+
+    sizes = {storage_object.file_path: storage_object.size for storage_object in transfer.list_objects('foo')}
+    assert sizes == {'a': len('replicated'), 'b': len('staged')}
@@ -0,0 +1,74 @@
+import os
+
+from blockserver.backend.striped import StripedLocalTransfer, parse_volume
+from blockserver.backend.transfer import StorageObject
+
+
+def store(transfer, prefix, path, testfile):
+    with open(testfile, 'wb') as file:
+        file.write(b'Dummy\n')
+    return transfer.store(StorageObject(prefix, path, local_file=testfile))
+
+
+def volume_of(transfer, storage_object):
+    return [volume for volume in transfer.volumes if volume._path(storage_object).exists()]
+
+
+def test_parse_volume():
+    assert parse_volume('/srv/a') == ('/srv/a', 1.0)
+    assert parse_volume('/srv/a:2') == ('/srv/a', 2.0)
+
+
+def test_objects_are_spread(cache, testfile, tmpdir):
+    transfer = StripedLocalTransfer([str(tmpdir.join('a')), str(tmpdir.join('b'))], cache, reserve=0)
+    for index in range(50):
+        store(transfer, 'foo', 'block/%d' % index, testfile)
+    counts = [sum(1 for _ in volume.list_objects('foo')) for volume in transfer.volumes]
+    assert sum(counts) == 50
+    assert all(counts)
+    assert len(list(transfer.list_objects('foo'))) == 50
+
+    cache.flush()
+    storage_object = StorageObject('foo', 'block/7')
+    assert volume_of(transfer, storage_object) == transfer._ranked(storage_object)[:1]
+    assert transfer.meta(storage_object).size == len(b'Dummy\n')
+    downloaded = transfer.retrieve(storage_object)
+    assert downloaded.fd.read() == b'Dummy\n'
+    downloaded.fd.close()
+    assert transfer.delete(storage_object) == len(b'Dummy\n')
+    assert transfer.meta(storage_object) is None
+
+
+def test_full_volumes_are_skipped(cache, testfile, tmpdir):
+    transfer = StripedLocalTransfer([str(tmpdir.join('a')), str(tmpdir.join('b'))], cache, reserve=0)
+    full = transfer.volumes[0]
+    transfer._has_room = lambda volume, size: volume is not full
+    for index in range(10):
+        store(transfer, 'foo', 'block/%d' % index, testfile)
+    assert not list(full.list_objects('foo'))
+
+
+def test_upload_directory_skips_full_volume(cache, tmpdir):
+    transfer = StripedLocalTransfer([str(tmpdir.join('a')), str(tmpdir.join('b'))], cache, reserve=0)
+    storage_object = StorageObject('foo', 'block/bar')
+    preferred, other = transfer._ranked(storage_object)
+    assert transfer.upload_directory(storage_object).startswith(str(preferred.basepath))
+    transfer._has_room = lambda volume, size: volume is not preferred
+    assert transfer.upload_directory(storage_object).startswith(str(other.basepath))
+
+
+def test_rebalance_after_adding_volume(cache, testfile, tmpdir):
+    transfer = StripedLocalTransfer([str(tmpdir.join('a'))], cache, reserve=0)
+    for index in range(30):
+        store(transfer, 'foo', 'block/%d' % index, testfile)
+    etags = {o.file_path: o.etag for o in transfer.list_objects('foo')}
+
+    transfer = StripedLocalTransfer([str(tmpdir.join('a')), str(tmpdir.join('b'))], cache, reserve=0)
+    moved = transfer.rebalance_prefix('foo')
+    assert moved == sum(1 for _ in transfer.volumes[1].list_objects('foo'))
+    assert 0 < moved < 30
+    assert transfer.rebalance_prefix('foo') == 0
+    for storage_object in transfer.list_objects('foo'):
+        assert volume_of(transfer, storage_object) == transfer._ranked(storage_object)[:1]
+        assert etags[storage_object.file_path] == storage_object.etag
+    assert not [name for name in os.listdir(str(tmpdir.join('b'))) if name.startswith('.')]
@@ -0,0 +1,81 @@
+from blockserver.backend.staging import md5_etag
+from blockserver.backend.tiering import TieredTransfer
+from blockserver.backend.transfer import LocalTransfer, StorageObject
+
+
+class ColdTransfer(LocalTransfer):
+    """Local stand-in for S3Transfer, which assigns the MD5 of the content as etag."""
+
+    def store(self, storage_object, stored_size=None):
+        etag = md5_etag(storage_object.local_file)
+        new_object, size_diff = super().store(storage_object, stored_size)
+        new_object = new_object._replace(etag=etag)
+        self._to_cache(new_object)
+        return new_object, size_diff
+
+
+def make_transfer(tmpdir, cache, app_options):
+    app_options.tier_demote_interval = 0
+    # don't depend on the free space of the host
+    app_options.tier_hot_min_free = 0.0
+    cold = ColdTransfer(str(tmpdir.join('cold')), cache)
+    return TieredTransfer(str(tmpdir.join('hot')), cache, cold=cold), cold
+
+
+def store(transfer, path, content, testfile):
+    with open(testfile, 'wb') as file:
+        file.write(content)
+    etag = md5_etag(testfile)
+    uploaded, _ = transfer.store(StorageObject('foo', path, local_file=testfile))
+    assert uploaded.etag == etag
+    return uploaded
+
+
+def read(transfer, path):
+    downloaded = transfer.retrieve(StorageObject('foo', path))
+    try:
+        return downloaded.fd.read()
+    finally:
+        downloaded.fd.close()
+
+
+def test_writes_go_to_the_hot_tier(cache, testfile, tmpdir, app_options):
+    transfer, cold = make_transfer(tmpdir, cache, app_options)
+    store(transfer, 'block/a', b'content', testfile)
+    assert transfer._hot_path(StorageObject('foo', 'block/a')).exists()
+    assert not (cold.basepath / 'foo' / 'block' / 'a').exists()
+    cache.flush()
+    assert read(transfer, 'block/a') == b'content'
+
+
+def test_demote_and_promote(cache, testfile, tmpdir, app_options):
+    transfer, cold = make_transfer(tmpdir, cache, app_options)
+    uploaded = store(transfer, 'cold', b'cold content', testfile)
+    app_options.tier_cold_after = 3600
+    assert transfer.demote() == 0
+
+    app_options.tier_cold_after = 0
+    app_options.tier_promote_hits = 2
+    assert transfer.demote() == 1
+    assert not transfer._hot_path(StorageObject('foo', 'cold')).exists()
+    assert transfer.meta(StorageObject('foo', 'cold')).etag == uploaded.etag
+
+    assert read(transfer, 'cold') == b'cold content'
+    assert not transfer._hot_path(StorageObject('foo', 'cold')).exists()
+    assert read(transfer, 'cold') == b'cold content'
+    transfer._promotions.shutdown(wait=True)
+    assert transfer._hot_path(StorageObject('foo', 'cold')).exists()
+    cache.flush()
+    assert transfer.meta(StorageObject('foo', 'cold')).etag == uploaded.etag
+
+
+def test_delete_removes_both_tiers(cache, testfile, tmpdir, app_options):
+    transfer, cold = make_transfer(tmpdir, cache, app_options)
+    store(transfer, 'a', b'first', testfile)
+    app_options.tier_cold_after = 0
+    transfer.demote()
+    store(transfer, 'a', b'second', testfile)
+    assert sorted((o.file_path, o.size) for o in transfer.list_objects('foo')) == [('a', 6)]
+    assert transfer.delete(StorageObject('foo', 'a')) == 6
+    assert transfer.meta(StorageObject('foo', 'a')) is None
+    assert not (cold.basepath / 'foo' / 'a').exists()
@@ -1,6 +1,8 @@
 from blockserver.backend.transfer import StorageObject
 from blockserver.backend import transfer as transfer_module
 import os
+import tempfile
+import pytest
 
 
 def test_basic(testfile, cache, transfer):
@@ -17,6 +19,14 @@ def test_basic(testfile, cache, transfer):
     assert size == delete_size
 
 
+def test_store_trusts_stored_size(testfile, cache, transfer):
+    size = os.path.getsize(testfile)
+    storage_object = StorageObject('foo', 'bar', local_file=testfile)
+    transfer.delete(storage_object)
+    _, size_diff = transfer.store(storage_object, 3)
+    assert size_diff == size - 3
+
+
 def test_delete_non_existing_file(testfile, cache, transfer):
     t = transfer
     storage_object = StorageObject('foo', 'bar')
@@ -79,3 +89,101 @@ def test_meta(testfile, cache, transfer):
 
 def test_meta_non_existing_file(cache, transfer):
     assert transfer.meta(StorageObject('making-things', 'up')) is None
+
+
+def test_list_objects(testfile, cache, transfer):
+    size = os.path.getsize(testfile)
+    for path in ('bar', 'block/baz', 'block/qux'):
+        with open(testfile, 'wb') as file:
+            file.write(b'Dummy\n')
+        transfer.store(StorageObject('list-prefix', path, local_file=testfile))
+    listed = sorted(transfer.list_objects('list-prefix'))
+    assert [(o.prefix, o.file_path, o.size) for o in listed] == [
+        ('list-prefix', 'bar', size), ('list-prefix', 'block/baz', size), ('list-prefix', 'block/qux', size)]
+    assert all(o.etag for o in listed)
+    assert list(transfer.list_objects('empty-prefix')) == []
+
+
+def test_sharded_layout(testfile, cache, tmpdir):
+    transfer = transfer_module.LocalTransfer(str(tmpdir), cache, fanout=2)
+    size = os.path.getsize(testfile)
+    uploaded, _ = transfer.store(StorageObject('foo', 'block/bar', local_file=testfile))
+    relative = os.path.relpath(uploaded.local_file, str(tmpdir)).split(os.sep)
+    assert relative[0] == 'foo'
+    assert relative[1].startswith('@') and relative[2].startswith('@')
+    assert relative[3:] == ['block', 'bar']
+    cache.flush()
+    assert transfer.meta(StorageObject('foo', 'block/bar')).size == size
+    assert [o.file_path for o in transfer.list_objects('foo')] == ['block/bar']
+    assert transfer.delete(StorageObject('foo', 'block/bar')) == size
+
+
+def test_upload_directory_is_renamed(cache, tmpdir):
+    transfer = transfer_module.LocalTransfer(str(tmpdir), cache, fanout=2)
+    storage_object = StorageObject('foo', 'block/bar')
+    directory = transfer.upload_directory(storage_object)
+    assert os.path.dirname(directory) == str(tmpdir)
+    with tempfile.NamedTemporaryFile(dir=directory) as upload:
+        upload.write(b'Dummy\n')
+        upload.flush()
+        inode = os.stat(upload.name).st_ino
+        uploaded, _ = transfer.store(storage_object._replace(local_file=upload.name))
+    assert os.stat(uploaded.local_file).st_ino == inode
+    assert os.listdir(directory) == []
+    assert list(transfer.list_objects('foo'))[0].file_path == 'block/bar'
+
+
+def test_stale_uploads_are_removed(cache, tmpdir):
+    directory = transfer_module.LocalTransfer(str(tmpdir), cache).upload_directory(StorageObject('foo', 'bar'))
+    stale = os.path.join(directory, 'stale')
+    recent = os.path.join(directory, 'recent')
+    for path in (stale, recent):
+        open(path, 'wb').close()
+    old = os.stat(stale).st_mtime - transfer_module.LocalTransfer.STALE_UPLOAD_AGE - 1
+    os.utime(stale, (old, old))
+    transfer_module.LocalTransfer(str(tmpdir), cache)
+    assert os.listdir(directory) == ['recent']
+
+
+def test_copy_links(testfile, cache, tmpdir):
+    transfer = transfer_module.LocalTransfer(str(tmpdir), cache, fanout=2)
+    size = os.path.getsize(testfile)
+    stored, _ = transfer.store(StorageObject('foo', 'bar', local_file=testfile))
+    copied, size_diff = transfer.copy(StorageObject('foo', 'bar'), StorageObject('baz', 'block/bar'))
+    assert size_diff == size
+    assert os.stat(copied.local_file).st_ino == os.stat(stored.local_file).st_ino
+    assert transfer.delete(StorageObject('foo', 'bar')) == size
+    assert transfer.retrieve(StorageObject('baz', 'block/bar')).fd.read() == b'Dummy\n'
+    with pytest.raises(FileNotFoundError):
+        transfer.copy(StorageObject('foo', 'bar'), StorageObject('baz', 'qux'))
+
+
+def test_migrate_flat_layout(testfile, cache, tmpdir):
+    flat = transfer_module.LocalTransfer(str(tmpdir), cache, fanout=0)
+    for path in ('bar', 'block/baz'):
+        with open(testfile, 'wb') as file:
+            file.write(b'Dummy\n')
+        flat.store(StorageObject('foo', path, local_file=testfile))
+    cache.flush()
+
+    sharded = transfer_module.LocalTransfer(str(tmpdir), cache, fanout=2, flat_fallback=True)
+    assert sharded.meta(StorageObject('foo', 'block/baz')).size == 6
+    assert sorted(o.file_path for o in sharded.list_objects('foo')) == ['bar', 'block/baz']
+
+    assert sharded.migrate_prefix('foo') == 2
+    assert not (tmpdir / 'foo' / 'bar').exists()
+    cache.flush()
+    sharded.flat_fallback = False
+    assert sorted(o.file_path for o in sharded.list_objects('foo')) == ['bar', 'block/baz']
+    assert sharded.meta(StorageObject('foo', 'bar')).size == 6
+
+
+def test_s3_hashed_keys(cache):
+    transfer = transfer_module.S3Transfer(cache, fanout=2, flat_fallback=True)
+    storage_object = StorageObject('foo', 'block/bar')
+    shard, key = transfer._key(storage_object).split('/', 1)
+    assert key == 'foo/block/bar'
+    assert shard in transfer._shards()
+    assert len(transfer._shards()) == 256
+    assert transfer._keys(storage_object)[1] == 'foo/block/bar'
+    assert transfer_module.S3Transfer(cache, fanout=0)._key(storage_object) == 'foo/block/bar'
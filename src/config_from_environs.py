@@ -16,5 +16,7 @@ with env.prefixed('BLOCK_'):
     transfers = env.int('TRANSFERS', 10)
 
 psql_dsn = env('DATABASE_URL')
+psql_replica_dsn = env.list('DATABASE_REPLICA_URLS', [])
+psql_replica_max_lag = env.float('DATABASE_REPLICA_MAX_LAG', 5.0)
 redis_host = env('REDIS_HOST', 'redis')
 redis_port = env.int('REDIS_PORT', 6379)
@@ -133,6 +133,16 @@ def pg_connection(request):
     return conn
 
 
+@pytest.yield_fixture
+def pg_replica_connection(pg_connection):
+    """A second connection to the test database, standing in for a read replica."""
+    import environs
+    env = environs.Env()
+    conn = psycopg2.connect(dsn=env('DATABASE_URL'))
+    yield conn
+    conn.close()
+
+
 @pytest.fixture
 def pg_pool(pg_connection):
     class TestPool:
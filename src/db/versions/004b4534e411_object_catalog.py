@@ -0,0 +1,37 @@
+"""
+Create an objects table cataloguing the stored objects of every prefix.
+
+Revision ID: 004b4534e411
+Revises: aa3320db4c7f
+Create Date: 2026-10-19 10:12:31.270415
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '004b4534e411'
+down_revision = 'aa3320db4c7f'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'objects',
+        sa.Column('prefix', sa.TEXT, nullable=False),
+        sa.Column('path', sa.TEXT, nullable=False),
+        sa.Column('size', sa.BIGINT, nullable=False),
+        sa.Column('etag', sa.TEXT, nullable=False),
+        sa.Column('mtime', sa.TIMESTAMP(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+    # the primary key doubles as the index for keyset-paginated listings (ORDER BY path)
+    op.create_primary_key(
+        'pk_objects', 'objects',
+        ['prefix', 'path']
+    )
+
+
+def downgrade():
+    op.drop_table('objects')
@@ -0,0 +1,31 @@
+"""
+Create a pending_deletions table of deleted objects that are still in the storage backend (--deferred-deletes).
+
+Revision ID: 3b7f0c9a6e12
+Revises: 9e41b7c05d2a
+Create Date: 2026-10-19 17:41:05.236118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b7f0c9a6e12'
+down_revision = '9e41b7c05d2a'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'pending_deletions',
+        sa.Column('prefix', sa.TEXT, primary_key=True),
+        sa.Column('path', sa.TEXT, primary_key=True),
+        sa.Column('queued', sa.TIMESTAMP, nullable=False, server_default=sa.func.now()),
+    )
+    op.create_index('pending_deletions_queued', 'pending_deletions', ['queued'])
+
+
+def downgrade():
+    op.drop_table('pending_deletions')
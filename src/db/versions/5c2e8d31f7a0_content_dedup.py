@@ -0,0 +1,33 @@
+"""
+Create a blobs table with reference counts of deduplicated contents, referenced by objects.digest.
+
+Revision ID: 5c2e8d31f7a0
+Revises: 004b4534e411
+Create Date: 2026-10-19 14:02:11.518227
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c2e8d31f7a0'
+down_revision = '004b4534e411'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'blobs',
+        sa.Column('digest', sa.TEXT, primary_key=True),
+        sa.Column('size', sa.BIGINT, nullable=False),
+        sa.Column('refcount', sa.INTEGER, nullable=False),
+    )
+    # NULL for objects stored under their own path
+    op.add_column('objects', sa.Column('digest', sa.TEXT, nullable=True))
+
+
+def downgrade():
+    op.drop_column('objects', 'digest')
+    op.drop_table('blobs')
@@ -0,0 +1,26 @@
+"""
+Add objects.checksum, the SHA-256 of the content of catalogued objects.
+
+Revision ID: 9e41b7c05d2a
+Revises: 5c2e8d31f7a0
+Create Date: 2026-10-19 15:20:47.902114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e41b7c05d2a'
+down_revision = '5c2e8d31f7a0'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # NULL for objects catalogued before
+    op.add_column('objects', sa.Column('checksum', sa.TEXT, nullable=True))
+
+
+def downgrade():
+    op.drop_column('objects', 'checksum')